@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import json
+import time
+import bisect
+import threading
+
+from collections import OrderedDict
+
+# Latency histogram bucket edges in seconds, four buckets per doubling
+# from 50ns up to ~100s
+_EDGES = [5e-8 * 2 ** (i / 4.0) for i in range(85)]
+
+_PERCENTILES = [50, 90, 99]
+
+
+class funcstats(object):
+    __slots__ = ['name', 'calls', 'total', 'convert', 'native', 'max', 'buckets',
+                 '_lock']
+
+    def __init__(self, name):
+        self.name = name
+        # Calls come from any thread (submit, run_many, ...)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.total = 0.0
+            self.convert = 0.0
+            self.native = 0.0
+            self.max = 0.0
+            self.buckets = [0] * (len(_EDGES) + 1)
+
+    def add(self, convert, native, n=1):
+        # n calls timed together (cfunc.map) count with their mean time
+        t = convert + native
+        mean = t / n
+        with self._lock:
+            self.calls += n
+            self.total += t
+            self.convert += convert
+            self.native += native
+            if mean > self.max:
+                self.max = mean
+            self.buckets[bisect.bisect(_EDGES, mean)] += n
+
+    def percentile(self, p):
+        # Upper edge of the bucket holding the p'th percentile call
+        if self.calls == 0:
+            return 0.0
+        want = self.calls * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= want and n:
+                if i < len(_EDGES):
+                    return min(_EDGES[i], self.max)
+                return self.max
+        return self.max
+
+    def histogram(self):
+        """
+        Returns a list of (upper edge in seconds, count) for the non-empty
+        latency buckets, the last edge is None for calls above the range
+        """
+        res = []
+        for i, n in enumerate(self.buckets):
+            if n:
+                res.append((_EDGES[i] if i < len(_EDGES) else None, n))
+        return res
+
+    def as_dict(self):
+        res = OrderedDict([('calls', self.calls), ('total', self.total),
+                           ('mean', self.total / self.calls if self.calls else 0.0),
+                           ('convert', self.convert), ('native', self.native)])
+        for p in _PERCENTILES:
+            res['p%d' % p] = self.percentile(p)
+        res['max'] = self.max
+        res['histogram'] = self.histogram()
+        return res
+
+
+def timedCall(f, convs, stats):
+    # Same calling convention as cfunc._make_call but every call is timed,
+    # the split only exists when pyctype converts arguments itself, otherwise
+    # the ctypes marshalling is counted as native time
+    clock = time.perf_counter
+    add = stats.add
+
+    if not any(convs):
+        def call(*args):
+            t0 = clock()
+            res = f(*args)
+            add(0.0, clock() - t0)
+            return res
+    else:
+        def call(*args):
+            t0 = clock()
+            cargs = [a if c is None else c(a) for c, a in zip(convs, args)]
+            t1 = clock()
+            res = f(*cargs)
+            add(t1 - t0, clock() - t1)
+            return res
+
+    return call
+
+
+class callstats(object):
+    def __init__(self):
+        self.funcs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        try:
+            return self.funcs[name]
+        except KeyError:
+            pass
+        with self._lock:
+            try:
+                return self.funcs[name]
+            except KeyError:
+                x = self.funcs[name] = funcstats(name)
+                return x
+
+    def reset(self):
+        for s in self.funcs.values():
+            s.reset()
+
+    def as_dict(self):
+        # Busiest functions first
+        order = sorted(self.funcs.values(), key=lambda s: s.total, reverse=True)
+        return OrderedDict((s.name, s.as_dict()) for s in order if s.calls)
+
+    def dump(self, filename=None):
+        res = json.dumps(self.as_dict(), indent=1)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(res)
+        return res
@@ -0,0 +1,255 @@
+from __future__ import print_function
+
+import threading
+
+# Every descriptor is interned on its contents, so the many references to
+# the same type (every int argument, every member of a struct type, ...)
+# share one object
+_interned = {}
+_internLock = threading.Lock()
+
+
+def intern(x):
+    try:
+        return _interned[x]
+    except KeyError:
+        pass
+    with _internLock:
+        return _interned.setdefault(x, x)
+
+
+def _load(cls, values):
+    # Unpickling goes back through the intern table
+    return intern(cls(*values))
+
+
+class desc(object):
+    """
+    Immutable parsed DWARF entry. Attributes are the fast path, the
+    mapping interface keeps the old dict based layout working.
+    """
+    __slots__ = ['_hash']
+    # (mapping key, attribute) pairs
+    _keys = ()
+    # Whether a None attribute means the key is absent
+    _optional = True
+
+    def __init__(self, *values):
+        for (key, attr), value in zip(self._keys, values):
+            object.__setattr__(self, attr, value)
+        object.__setattr__(self, '_hash', hash((type(self), self._values())))
+
+    def _values(self):
+        return tuple(getattr(self, attr) for key, attr in self._keys)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def replace(self, **kwargs):
+        """
+        Returns an interned copy with the given attributes changed
+        """
+        values = [kwargs.pop(attr, getattr(self, attr)) for key, attr in self._keys]
+        if kwargs:
+            raise TypeError('Unknown fields %s' % sorted(kwargs))
+        return intern(type(self)(*values))
+
+    def __reduce__(self):
+        return (_load, (type(self), self._values()))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is type(self):
+            return self._hash == other._hash and self._values() == other._values()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % i for i in self.items()))
+
+    # Mapping interface
+    def keys(self):
+        if not self._optional:
+            return [key for key, attr in self._keys]
+        return [key for key, attr in self._keys if getattr(self, attr) is not None]
+
+    def __getitem__(self, key):
+        for k, attr in self._keys:
+            if k == key:
+                value = getattr(self, attr)
+                if value is None and self._optional:
+                    break
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+class TypeDesc(desc):
+    # const is set by a const anywhere in the chain, pconst only by one on
+    # the data the pointers lead to
+    __slots__ = ['type', 'ptrs', 'size', 'struct', 'array', 'const', 'union',
+                 'pconst']
+    _keys = tuple((i, i) for i in __slots__)
+    _optional = False
+
+
+class VarDesc(desc):
+    # Variables, function arguments and struct members, bits is the width
+    # of bitfield members
+    __slots__ = ['type', 'loc', 'bytes', 'linkage_name', 'bits']
+    _keys = (('def', 'type'), ('loc', 'loc'), ('bytes', 'bytes'),
+             ('linkage_name', 'linkage_name'), ('bits', 'bits'))
+
+
+class _argsDesc(desc):
+    # Members are kept as a read only mapping of name -> VarDesc
+    __slots__ = []
+
+    def __init__(self, *values):
+        values = list(values)
+        i = [attr for key, attr in self._keys].index('args')
+        args = values[i] or ()
+        if hasattr(args, 'items'):
+            args = args.items()
+        values[i] = argmap(args)
+        desc.__init__(self, *values)
+
+
+class FuncDesc(_argsDesc):
+    __slots__ = ['type', 'args', 'linkage_name']
+    _keys = (('def', 'type'), ('args', 'args'), ('linkage_name', 'linkage_name'))
+
+
+class StructDesc(_argsDesc):
+    __slots__ = ['type', 'args', 'bytes']
+    _keys = (('def', 'type'), ('args', 'args'), ('bytes', 'bytes'))
+
+
+class argmap(object):
+    """
+    Ordered name -> VarDesc mapping which can not be changed once built
+    """
+    __slots__ = ['_keys', '_data', '_hash']
+
+    def __init__(self, items=()):
+        items = tuple(items)
+        object.__setattr__(self, '_keys', tuple(k for k, v in items))
+        object.__setattr__(self, '_data', dict(items))
+        object.__setattr__(self, '_hash', hash(items))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('argmap is immutable')
+
+    def __reduce__(self):
+        return (argmap, (self.items(),))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, argmap):
+            return self._hash == other._hash and self.items() == other.items()
+        if isinstance(other, dict):
+            return self._data == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    def __repr__(self):
+        return 'argmap(%r)' % (self.items(),)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self._data[k] for k in self._keys]
+
+    def items(self):
+        return [(k, self._data[k]) for k in self._keys]
+
+
+def typeDesc(x):
+    array = x['array']
+    if array:
+        array = tuple(tuple(i) for i in array)
+    return intern(TypeDesc(x['type'], x['ptrs'], x['size'], x['struct'],
+                           array, x['const'], x['union'], x.get('pconst', False)))
+
+
+def _varDesc(x):
+    return intern(VarDesc(x.get('def'), x.get('loc'), x.get('bytes'),
+                          x.get('linkage_name'), x.get('bits')))
+
+
+def _args(x):
+    return [(k, _varDesc(v)) for k, v in x.get('args', {}).items()]
+
+
+def compactEntry(kind, x):
+    # Turns one cleaned parseDIE entry into its descriptor
+    if kind == 'funcs':
+        return intern(FuncDesc(x.get('def'), _args(x), x.get('linkage_name')))
+    if kind == 'structs':
+        return intern(StructDesc(x.get('def'), _args(x), x.get('bytes')))
+    return _varDesc(x)
+
+
+def compact(tables):
+    for kind, table in tables.items():
+        for name in list(table.keys()):
+            table[name] = compactEntry(kind, table[name])
+    return tables
@@ -0,0 +1,115 @@
+from __future__ import print_function
+
+import os
+import struct
+import pickle
+import hashlib
+
+from .version import __version__
+
+# Bump whenever the layout of the parseDIE output changes
+_CACHE_VERSION = 6
+
+_SHT_NOTE = 7
+_NT_GNU_BUILD_ID = 3
+
+
+def cacheDir(cache_dir=None):
+    if cache_dir is not None:
+        return cache_dir
+    if 'PYCTYPE_CACHE_DIR' in os.environ:
+        return os.environ['PYCTYPE_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pyctype')
+
+
+def buildID(filename):
+    # Read the GNU build-id note straight from the section headers so that
+    # checking the cache never needs pyelftools
+    with open(filename, 'rb') as f:
+        ident = bytearray(f.read(16))
+        if ident[:4] != b'\x7fELF':
+            return None
+        is64 = ident[4] == 2
+        endian = '<' if ident[5] == 1 else '>'
+
+        if is64:
+            hdr = struct.Struct(endian + 'HHIQQQIHHHHHH')
+            shdr = struct.Struct(endian + 'IIQQQQIIQQ')
+        else:
+            hdr = struct.Struct(endian + 'HHIIIIIHHHHHH')
+            shdr = struct.Struct(endian + 'IIIIIIIIII')
+
+        h = hdr.unpack(f.read(hdr.size))
+        shoff, shentsize, shnum = h[5], h[10], h[11]
+
+        for i in range(shnum):
+            f.seek(shoff + i * shentsize)
+            sh = shdr.unpack(f.read(shdr.size))
+            if sh[1] != _SHT_NOTE:
+                continue
+            f.seek(sh[4])
+            data = f.read(sh[5])
+            pos = 0
+            while pos + 12 <= len(data):
+                namesz, descsz, ntype = struct.unpack_from(endian + 'III',
+                                                           data, pos)
+                pos += 12
+                name = data[pos:pos + namesz]
+                pos += (namesz + 3) & ~3
+                desc = data[pos:pos + descsz]
+                pos += (descsz + 3) & ~3
+                if ntype == _NT_GNU_BUILD_ID and name.rstrip(b'\0') == b'GNU':
+                    return ''.join('%02x' % c for c in bytearray(desc))
+    return None
+
+
+def cacheKey(filename, options=None):
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    return (_CACHE_VERSION, __version__, path, st.st_size, st.st_mtime,
+            buildID(path), options)
+
+
+def cacheFile(filename, cache_dir=None, options=None):
+    # Each set of parse options gets its own file, so parsing with other
+    # options does not evict it
+    path = os.path.abspath(filename)
+    h = hashlib.sha1(path.encode())
+    if options is not None:
+        h.update(repr(options).encode())
+    return os.path.join(cacheDir(cache_dir), h.hexdigest() + '.pickle')
+
+
+def loadCache(filename, cache_dir=None, options=None):
+    try:
+        with open(cacheFile(filename, cache_dir, options), 'rb') as f:
+            key, data = pickle.load(f)
+    except Exception:
+        return None
+
+    if key != cacheKey(filename, options):
+        return None
+    return data
+
+
+def saveCache(filename, data, cache_dir=None, options=None):
+    # The cache is only an optimisation, failing to write it never fails
+    # the load
+    fname = cacheFile(filename, cache_dir, options)
+    # Write then rename so concurrent readers never see a partial file
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump((cacheKey(filename, options), data), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, fname)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    return True
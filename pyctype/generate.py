@@ -0,0 +1,282 @@
+from __future__ import print_function
+
+import os
+import ctypes
+import keyword
+
+from collections import OrderedDict
+
+from .parsedwarf import parseDwarf
+from .pyctype import _dictCTypes
+from .version import __version__
+
+
+_header = '''"""
+ctypes bindings for {library}
+
+Generated by pyctype {version}, do not edit. Importing this module needs
+neither pyelftools nor the DWARF information of the library.
+"""
+import ctypes
+
+LIBRARY = {library!r}
+
+
+class _Func(object):
+    # Looks up the symbol on first use, then caches the ctypes function
+    # on the instance so later lookups bypass the descriptor
+    def __init__(self, name, restype, argtypes):
+        self.name = name
+        self.restype = restype
+        self.argtypes = argtypes
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        f = getattr(obj._lib, self.name)
+        f.restype = self.restype
+        if self.argtypes is not None:
+            f.argtypes = self.argtypes
+        obj.__dict__[self.name] = f
+        return f
+
+
+class _Global(object):
+    def __init__(self, name, ctype, const=False):
+        self.name = name
+        self.ctype = ctype
+        self.const = const
+
+    def _get(self, obj):
+        try:
+            return obj._globals[self.name]
+        except KeyError:
+            x = obj._globals[self.name] = self.ctype.in_dll(obj._lib, self.name)
+            return x
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        x = self._get(obj)
+        if isinstance(x, ctypes._SimpleCData):
+            return x.value
+        return x
+
+    def __set__(self, obj, value):
+        if self.const:
+            raise AttributeError('Can not set const variable')
+        x = self._get(obj)
+        if isinstance(x, ctypes._SimpleCData):
+            x.value = value
+        else:
+            ctypes.memmove(ctypes.addressof(x), ctypes.addressof(value),
+                           ctypes.sizeof(x))
+
+'''
+
+_footer = '''
+
+def load(path=LIBRARY):
+    return Library(path)
+
+
+_default = None
+
+def __getattr__(name):
+    # Module level access goes through a Library loaded on first use
+    global _default
+    if name.startswith('__'):
+        raise AttributeError(name)
+    if _default is None:
+        _default = Library()
+    return getattr(_default, name)
+'''
+
+
+def _ident(name):
+    if keyword.iskeyword(name):
+        return name + '_'
+    return name
+
+
+class _generator(object):
+    def __init__(self, parsed):
+        self.funcs = parsed['funcs']
+        self.var = parsed['var']
+        # Only aggregates with members become classes
+        self.structs = OrderedDict((k, v) for k, v in parsed['structs'].items()
+                                   if v['args'])
+        self.packed = set()
+
+    def baseExpr(self, x):
+        if x['type'] in self.structs and (x['struct'] or x['union'] or x['ptrs']):
+            return _ident(x['type'])
+        try:
+            return 'ctypes.' + _dictCTypes[(x['type'], x['size'])].__name__
+        except KeyError:
+            pass
+        if x['ptrs'] > 0:
+            return None
+        if x['size'] > 0:
+            return '(ctypes.c_ubyte * %d)' % x['size']
+        return None
+
+    def typeExpr(self, x):
+        if x is None:
+            return 'None'
+        res = self.baseExpr(x)
+        nptrs = x['ptrs']
+        if res is None:
+            if nptrs == 0:
+                return 'None'
+            # void *
+            res = 'ctypes.c_void_p'
+            nptrs -= 1
+        for i in range(nptrs):
+            res = 'ctypes.POINTER(%s)' % res
+        if x['array']:
+            for lower, upper in reversed(x['array']):
+                if upper >= lower:
+                    res = '(%s * %d)' % (res, upper - lower + 1)
+        return res
+
+    def deps(self, name):
+        # Structs and unions that must be complete before this one, pointers
+        # do not count
+        for arg in self.structs[name]['args'].values():
+            x = arg['def']
+            if x['ptrs'] == 0 and (x['struct'] or x['union']) and \
+                    x['type'] in self.structs and x['type'] != name:
+                yield x['type']
+
+    def order(self):
+        done = OrderedDict()
+        def visit(name, stack):
+            if name in done or name in stack:
+                return
+            stack.add(name)
+            for d in self.deps(name):
+                visit(d, stack)
+            done[name] = True
+        for name in self.structs:
+            visit(name, set())
+        return list(done)
+
+    def fields(self, name):
+        # (name, type) or (name, type, bits) for bitfields
+        st = self.structs[name]
+        res = []
+        if name not in self.packed:
+            for key, arg in st['args'].items():
+                if arg.get('bits') is not None:
+                    res.append((key, self.typeExpr(arg['def']), arg['bits']))
+                else:
+                    res.append((key, self.typeExpr(arg['def'])))
+            return res
+
+        # Explicit padding to the DWARF offsets, bitfields have none and
+        # are left inside the padding
+        pos = 0
+        npad = 0
+        for key, arg in sorted(st['args'].items(), key=lambda i: i[1].get('loc', 0)):
+            if arg.get('bits') is not None:
+                continue
+            if arg.get('loc', 0) > pos:
+                res.append(('_pad%d' % npad, 'ctypes.c_ubyte * %d' % (arg.get('loc', 0) - pos)))
+                npad += 1
+            elif arg.get('loc', 0) < pos:
+                continue
+            res.append((key, self.typeExpr(arg['def'])))
+            pos = arg.get('loc', 0) + self._fieldSize(name, key)
+        if st['def']['size'] > pos:
+            res.append(('_pad%d' % npad, 'ctypes.c_ubyte * %d' % (st['def']['size'] - pos)))
+        return res
+
+    def _fieldSize(self, name, key):
+        return self._sizes[name][key]
+
+    def source(self, library):
+        out = [_header.format(library=library, version=__version__)]
+
+        for name in self.structs:
+            base = 'ctypes.Union' if self.structs[name]['def']['union'] else 'ctypes.Structure'
+            out.append('class %s(%s):\n    pass\n\n' % (_ident(name), base))
+
+        for name in self.order():
+            if name in self.packed:
+                out.append('%s._pack_ = 1\n' % _ident(name))
+            out.append('%s._fields_ = [\n' % _ident(name))
+            for field in self.fields(name):
+                if len(field) == 3:
+                    out.append('    (%r, %s, %d),\n' % field)
+                else:
+                    out.append('    (%r, %s),\n' % field)
+            out.append('    ]\n\n')
+
+        out.append('\nclass Library(object):\n')
+        out.append('    def __init__(self, path=LIBRARY):\n')
+        out.append('        self._lib = ctypes.CDLL(path)\n')
+        out.append('        self._globals = {}\n\n')
+
+        for name, f in self.funcs.items():
+            args = [a.get('def') for a in f['args'].values()]
+            if any(a is None for a in args):
+                argtypes = 'None'
+            else:
+                argtypes = '[%s]' % ', '.join(self.typeExpr(a) for a in args)
+            out.append('    %s = _Func(%r, %s, %s)\n' % (_ident(name), name,
+                        self.typeExpr(f.get('def')), argtypes))
+        out.append('\n')
+
+        for name, v in self.var.items():
+            t = self.typeExpr(v.get('def'))
+            if t == 'None':
+                continue
+            out.append('    %s = _Global(%r, %s, %r)\n' % (_ident(name), name, t,
+                        bool(v['def']['const'])))
+
+        out.append(_footer)
+        return ''.join(out)
+
+    def check(self, library):
+        # Build the classes and compare their layout with the DWARF one,
+        # structs ctypes lays out differently are regenerated packed
+        while True:
+            ns = {}
+            exec(compile(self.source(library), '<pyctype bindings>', 'exec'), ns)
+            self._sizes = {}
+            bad = set()
+            for name, st in self.structs.items():
+                cls = ns[_ident(name)]
+                self._sizes[name] = {}
+                for key, arg in st['args'].items():
+                    # Members a packed layout left out, and bitfields whose
+                    # offset is their storage unit, only count through the size
+                    field = getattr(cls, key, None)
+                    if field is None or arg.get('bits') is not None:
+                        continue
+                    self._sizes[name][key] = field.size
+                    if field.offset != arg.get('loc', 0):
+                        bad.add(name)
+                if ctypes.sizeof(cls) != st['def']['size']:
+                    bad.add(name)
+            bad -= self.packed
+            if not bad:
+                return
+            self.packed |= bad
+
+
+def generate(filename, output=None, **kwargs):
+    """
+    Writes a plain Python module of ctypes bindings for filename,
+    returns the source. kwargs are passed to parseDwarf.
+    """
+    library = os.path.abspath(filename)
+    g = _generator(parseDwarf(filename, **kwargs))
+    g.check(library)
+    src = g.source(library)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(src)
+    return src
@@ -1,16 +1,44 @@
 from __future__ import print_function
 
 import sys
+import re
+import mmap
+import threading
+import fnmatch
+import hashlib
 
 from collections import OrderedDict
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 from elftools.common.py3compat import itervalues
 from elftools.elf.elffile import ELFFile
+from elftools.elf.sections import SymbolTableSection
 from elftools.dwarf.descriptions import (
     describe_DWARF_expr, set_global_machine_arch)
 from elftools.dwarf.locationlists import LocationEntry
 
+from .dwarfcache import loadCache, saveCache
+from .descriptors import TypeDesc, intern, compact, compactEntry
+
+# DIEs whose type definition gets resolved with parseType
+_baseTags = set(['DW_TAG_base_type', 'DW_TAG_member',
+                'DW_TAG_pointer_type','DW_TAG_array_type',
+                'DW_TAG_const_type'])
+
+_structTags = set(['DW_TAG_typedef', 'DW_TAG_union_type'])
+
+_typeTags = _baseTags | _structTags
+
+_argTags = set(['DW_TAG_formal_parameter', 'DW_TAG_unspecified_parameters'])
+
+# Only variables directly inside a CU can be found with in_dll
+_unitTags = set(['DW_TAG_compile_unit', 'DW_TAG_partial_unit'])
+
+# Reference forms that are relative to the start of the CU
+_refForms = set(['DW_FORM_ref1', 'DW_FORM_ref2', 'DW_FORM_ref4',
+                'DW_FORM_ref8', 'DW_FORM_ref', 'DW_FORM_ref_udata'])
+
 
 def listDIES(DIE):
     for k,v in DIE.items():
@@ -27,10 +55,38 @@ def listDIES2(DIE):
             pass
 
 
-def process_file(filename):
+class elfFile(object):
+    """
+    Opens filename for pyelftools through a read only mmap. The many
+    small header, symbol and section reads then become memory copies
+    served from the page cache instead of seek and read syscalls.
+    """
+    def __init__(self, filename, use_mmap=True):
+        self._file = open(filename, 'rb')
+        self._map = None
+        if use_mmap:
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files or filesystems which can not be mapped
+                pass
+        self.elffile = ELFFile(self._file if self._map is None else self._map)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self.elffile
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def process_file(filename, cu_offsets=None, use_mmap=True):
     #print('Processing file:', filename)
-    with open(filename, 'rb') as f:
-        elffile = ELFFile(f)
+    with elfFile(filename, use_mmap) as elffile:
         if not elffile.has_dwarf_info():
             raise ValueError(filename + ' has no DWARF info')
         # get_dwarf_info returns a DWARFInfo context object, which is the
@@ -40,12 +96,98 @@ def process_file(filename):
         # register names contained in DWARF expressions.
         set_global_machine_arch(elffile.get_machine_arch())
         alldies=OrderedDict()
-        for CU in dwarfinfo.iter_CUs():
+        if cu_offsets is None:
+            CUs = dwarfinfo.iter_CUs()
+        else:
+            CUs = [dwarfinfo.get_CU_at(i) for i in cu_offsets]
+        for CU in CUs:
             # A CU provides a simple API to iterate over all the DIEs in it.
             for DIE in CU.iter_DIEs():
                 alldies[DIE.offset] = DIE
     return alldies
-    
+
+
+def dynamicSymbols(elffile):
+    # Names ctypes.CDLL can resolve: defined functions and objects in .dynsym
+    res = set()
+    dynsym = elffile.get_section_by_name('.dynsym')
+    if not isinstance(dynsym, SymbolTableSection):
+        return res
+    for sym in dynsym.iter_symbols():
+        if sym['st_shndx'] == 'SHN_UNDEF':
+            continue
+        if sym['st_info']['type'] not in ('STT_FUNC', 'STT_OBJECT', 'STT_GNU_IFUNC'):
+            continue
+        if sym['st_info']['bind'] == 'STB_LOCAL':
+            continue
+        res.add(sym.name)
+    return res
+
+
+def _patterns(x):
+    # Strings are globs, compiled regular expressions are searched
+    if x is None:
+        return None
+    if isinstance(x, (str, re.Pattern)):
+        x = [x]
+    res = []
+    for p in x:
+        if isinstance(p, re.Pattern):
+            res.append((('re', p.pattern, p.flags), p.search))
+        else:
+            res.append((('glob', p), re.compile(fnmatch.translate(p)).match))
+    return res
+
+
+class symbolFilter(object):
+    """
+    Selects functions and variables by name and compilation units by the
+    source path in their DW_AT_name. Each of include, exclude and sources
+    is a glob, a compiled regular expression or a list of them.
+    """
+    def __init__(self, include=None, exclude=None, sources=None):
+        self.include = _patterns(include)
+        self.exclude = _patterns(exclude)
+        self.sources = _patterns(sources)
+
+    @staticmethod
+    def _any(patterns, name):
+        return any(match(name) for key, match in patterns)
+
+    def key(self):
+        # Picklable description for the cache key and file name, the order
+        # of the patterns does not change the selection
+        return tuple(None if p is None else tuple(sorted(set(key for key, match in p)))
+                     for p in (self.include, self.exclude, self.sources))
+
+    def unit(self, top):
+        if self.sources is None:
+            return True
+        try:
+            name = top.attributes['DW_AT_name'].value.decode()
+        except KeyError:
+            return False
+        return self._any(self.sources, name)
+
+    def symbol(self, name):
+        if self.include is not None and not self._any(self.include, name):
+            return False
+        return self.exclude is None or not self._any(self.exclude, name)
+
+    def named(self, name):
+        # Struct types are kept when include asks for them by name
+        return self.include is not None and self.symbol(name)
+
+
+def typeOffset(DIE):
+    # DIEs are keyed by their .debug_info offset but DW_AT_type is
+    # normally stored relative to its CU
+    attr = DIE.attributes['DW_AT_type']
+    if attr.form in _refForms:
+        return attr.value + DIE.cu.cu_offset
+    return attr.value
+
+
 def getAttr(DIE):
     res = OrderedDict()
     res['offset'] = DIE.offset
@@ -53,7 +195,7 @@ def getAttr(DIE):
         if attr.name == 'DW_AT_name':
             res['name']=attr.value.decode()
         if attr.name == 'DW_AT_type':
-            res['type_num']=attr.value
+            res['type_num']=typeOffset(DIE)
         # if attr.name == 'DW_AT_decl_file':
         #     res['file']=attr.value
         # if attr.name == 'DW_AT_decl_line':
@@ -62,6 +204,8 @@ def getAttr(DIE):
             res['loc'] = attr.value
         if attr.name == 'DW_AT_byte_size':
             res['bytes'] = attr.value
+        if attr.name == 'DW_AT_bit_size':
+            res['bits'] = attr.value
         if attr.name == 'DW_TAG_array_type':
             res['array'] = attr.value
         if attr.name == 'DIE DW_TAG_pointer_type':
@@ -84,129 +228,172 @@ def parseBT(base_type, x):
             x[k].args = parseBT(base_type, x[k]['args'])
     return x
 
-def parseType(DIE, child):
-    name = ''
-    size = -1
-    struct=False
-    array=False
-    const=False
-    union=False
-    num_ptrs = 0
+def typeStep(child):
+    # What a single DIE in a DW_AT_type chain contributes to the type,
+    # None marks a field this DIE does not set
+    name = None
+    size = None
+    array = None
+
+    try:
+        name = child.attributes['DW_AT_name'].value.decode()
+    except KeyError:
+        pass
+
+    try:
+        size = child.attributes['DW_AT_byte_size'].value
+    except KeyError:
+        pass
+
+    if child.tag == 'DW_TAG_typedef':
+        size = -1
+
+    if child.tag == 'DW_TAG_array_type':
+        array = []
+        for i in child.iter_children():
+            b = []
+            try:
+                b.append(i.attributes['DW_AT_lower_bound'].value)
+            except KeyError:
+                b.append(0)
+            try:
+                b.append(i.attributes['DW_AT_upper_bound'].value)
+            except KeyError:
+                b.append(-1)
+            array.append(b)
+
+    const = child.tag == 'DW_TAG_const_type'
+    return (name, size, child.tag == 'DW_TAG_typedef', array, const,
+            int(child.tag == 'DW_TAG_pointer_type'),
+            child.tag == 'DW_TAG_union_type', const)
+
+
+def mergeType(step, tail):
+    # Fields set further down the chain win, flags accumulate. The last
+    # field is const on the data behind all the pointers, which a const
+    # above a pointer does not reach.
+    if tail is None:
+        return step
+    return (tail[0] if tail[0] is not None else step[0],
+            tail[1] if tail[1] is not None else step[1],
+            step[2] or tail[2],
+            tail[3] if tail[3] is not None else step[3],
+            step[4] or tail[4],
+            step[5] + tail[5],
+            step[6] or tail[6],
+            tail[7] or (step[7] and not tail[5]))
+
+
+def parseType(DIE, child, memo=None):
+    # Each DIE offset is resolved once per memo, so chains shared between
+    # many DIEs (typedefs, structs) are only walked the first time
+    if memo is None:
+        memo = {}
+
+    start = child.offset
+    chain = []
+    seen = set()
+    tail = None
 
     while True:
+        if child.offset in memo:
+            tail = memo[child.offset][0]
+            break
+        chain.append(child)
+        seen.add(child.offset)
         try:
-            name = child.attributes['DW_AT_name'].value.decode()
-        except KeyError:
-            pass
-
-        try:
-            size = child.attributes['DW_AT_byte_size'].value
+            offset = typeOffset(child)
         except KeyError:
-            pass
-
-        if child.tag == 'DW_TAG_typedef':
-            size = -1
-            struct = True
-
-        if child.tag == 'DW_TAG_array_type':
-            array = []
-            for i in child.iter_children():
-                b = []
-                try:
-                    b.append(i.attributes['DW_AT_lower_bound'].value)
-                except KeyError:
-                    b.append(0)
-                try:
-                    b.append(i.attributes['DW_AT_upper_bound'].value)
-                except KeyError:
-                    b.append(-1)  
-                array.append(b)
-
-        if child.tag == 'DW_TAG_const_type':
-            const = True
-        
-        if child.tag == 'DW_TAG_pointer_type':
-            num_ptrs = num_ptrs + 1      
+            break
+        # Stop on self-referencing chains
+        if offset in seen or offset not in DIE:
+            break
+        child = DIE[offset]
+
+    for child in reversed(chain):
+        tail = mergeType(typeStep(child), tail)
+        name, size, struct, array, const, num_ptrs, union, pconst = tail
+        output = intern(TypeDesc(name if name is not None else '',
+                                 num_ptrs,
+                                 size if size is not None else -1,
+                                 struct,
+                                 tuple(tuple(i) for i in array) if array else False,
+                                 const,
+                                 union,
+                                 pconst))
+        memo[child.offset] = (tail, output)
+
+    return memo[start][1]
+
+
+def parseFunc(value, noname):
+    x = getAttr(value)
+    x['args'] = OrderedDict()
+    for j in value.iter_children():
+        # Skip local variables, lexical blocks etc
+        if j.tag not in _argTags:
+            continue
+        x2 = getAttr(j)
+        if 'name' not in x2:
+            name = 'NONAME%04d' % next(noname)
+        else:
+            name = x2['name']
+        x['args'][name] = x2
+    return x
 
-        if child.tag == 'DW_TAG_union_type':
-            union = True
 
+def parseStruct(DIEs, value, memo=None):
+    x = getAttr(value)
+    x['args'] = OrderedDict()
+    x['def'] = parseType(DIEs, value, memo)
+    # Get the definition, named unions carry their members themselves
+    if value.tag == 'DW_TAG_union_type':
+        st = value
+    else:
         try:
-            if child.attributes['DW_AT_type'].value in DIE:
-                child = DIE[child.attributes['DW_AT_type'].value]
-            else:
-                break
+            st = DIEs[typeOffset(value)]
         except KeyError:
-            break
-
-
-    output = {'type':name,
-            'ptrs':num_ptrs,
-            'size':size,
-            'struct':struct,
-            'array':array,
-            'const':const,
-            'union':union}
-
-    return output
+            return x
+    # Get elements of struct:
+    union = st.tag == 'DW_TAG_union_type'
+    for j in st.iter_children():
+        x2 = getAttr(j)
+        if union:
+            # Union members all start at the beginning
+            x2.setdefault('loc', 0)
+        x['args'][x2['name']] = x2
+    return x
 
 
-def parseDIE(DIEs):
+def parseDIE(DIEs, noname=None):
     funcs = OrderedDict()
     var = OrderedDict()
     base_type = OrderedDict()
     structs = OrderedDict()
 
-    bt = set(['DW_TAG_base_type', 'DW_TAG_member', 
-                'DW_TAG_pointer_type','DW_TAG_array_type',
-                'DW_TAG_const_type'])
-
-    bt2 = set(['DW_TAG_typedef', 'DW_TAG_union_type'])
-
-    noname_counter = 1
+    if noname is None:
+        noname = itertools.count(1)
+    memo = {}
 
     for key,value in DIEs.items():
         if value.tag == "DW_TAG_subprogram":
-            x = getAttr(value) 
-            n = x['name']
-            funcs[n] = x 
-            funcs[n]['args'] = OrderedDict()
-            for j in value.iter_children():
-                x2 = getAttr(j)
-                if 'name' not in x2:
-                    name = 'NONAME%04d' % noname_counter
-                    noname_counter += 1
-                else:
-                    name = x2['name']
-                funcs[n]['args'][name] = x2
-        if value.tag == "DW_TAG_variable":
+            x = parseFunc(value, noname)
+            funcs[x['name']] = x
+        if value.tag == "DW_TAG_variable" and value.get_parent().tag in _unitTags:
             x = getAttr(value)
             if 'name' not in x:
-                name = 'NONAME%04d' % noname_counter
-                noname_counter += 1
+                name = 'NONAME%04d' % next(noname)
             else:
                 name = x['name']
             var[name] = x
-        if value.tag in bt:
+        if value.tag in _baseTags:
             x = getAttr(value)
             base_type[x['offset']] = x
-            base_type[x['offset']]['def'] = parseType(DIEs, value)
-        if value.tag in bt2:
-            x = getAttr(value)
-            n = x['name']
-            structs[n] = x   
-            structs[n]['args'] = OrderedDict()    
+            base_type[x['offset']]['def'] = parseType(DIEs, value, memo)
+        if value.tag in _structTags:
+            x = parseStruct(DIEs, value, memo)
+            structs[x['name']] = x
             base_type[x['offset']] = x
-            base_type[x['offset']]['def'] = parseType(DIEs, value)
-            # Get the definition:
-            try:
-                st = DIEs[value.attributes['DW_AT_type'].value]
-            except KeyError:
-                continue
-            # Get elements of struct:
-            for j in st.iter_children():
-                x2 = getAttr(j)
-                structs[n]['args'][x2['name']] = x2            
 
     var = parseBT(base_type,var)
     funcs = parseBT(base_type, funcs)
@@ -216,8 +403,8 @@ def parseDIE(DIEs):
     var = cleanDict(var)
     funcs = cleanDict(funcs)
     structs = cleanDict(structs)
- 
-    return {'funcs':funcs, 'var':var, 'structs':structs}
+
+    return compact({'funcs':funcs, 'var':var, 'structs':structs})
 
 def cleanDict(x):
     for k in list(x.keys()):
@@ -228,9 +415,441 @@ def cleanDict(x):
             x[k] = cleanDict(x[k])
     return x
 
-def parseDwarf(filename):
-    DIEs =  process_file(filename)
-    return parseDIE(DIEs)
+class dieLookup(object):
+    """
+    Offset -> DIE mapping which only decodes a DIE when it is asked for
+    """
+    def __init__(self, dwarfinfo):
+        self.dwarfinfo = dwarfinfo
+
+    def __contains__(self, offset):
+        try:
+            self[offset]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, offset):
+        try:
+            return self.dwarfinfo.get_DIE_from_refaddr(offset)
+        except Exception:
+            raise KeyError(offset)
+
+
+class lazyBaseTypes(object):
+    """
+    Stands in for parseDIE's base_type table, resolving type chains
+    on first use
+    """
+    def __init__(self, DIEs, memo):
+        self.DIEs = DIEs
+        self.memo = memo
+        self._types = {}
+
+    def __contains__(self, offset):
+        return offset in self.DIEs and self.DIEs[offset].tag in _typeTags
+
+    def __getitem__(self, offset):
+        if offset not in self._types:
+            self._types[offset] = {'def': parseType(self.DIEs, self.DIEs[offset],
+                                                self.memo)}
+        return self._types[offset]
+
+
+class lazyTable(object):
+    """
+    Dict-like view of the funcs/var/structs tables where each entry
+    is only parsed the first time it is looked up. Entries are parsed
+    under lock, which tables sharing one DWARF reader have to share.
+    """
+    def __init__(self, index, resolve, lock=None, close=None):
+        self._index = index
+        self._resolve = resolve
+        self._data = {}
+        self._lock = threading.RLock() if lock is None else lock
+        if close is not None:
+            self.close = close
+
+    def __contains__(self, name):
+        return name in self._data or name in self._index
+
+    def __getitem__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            pass
+        with self._lock:
+            try:
+                return self._data[name]
+            except KeyError:
+                pass
+            x = self._resolve(self._index[name])
+            self._data[name] = x
+            return x
+
+    def __setitem__(self, name, value):
+        self._data[name] = value
+
+    def keys(self):
+        return list(self._index.keys()) + [k for k in self._data if k not in self._index]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class lazyDwarf(object):
+    """
+    Builds a name -> (CU, DIE offset) index from the top level DIEs of
+    each CU, the full definition of a symbol is parsed on first access.
+    The ELF file stays open for the lifetime of this object.
+
+    With exported=True only functions and variables in .dynsym are indexed,
+    a symbolFilter in select skips whole CUs and symbols by name. An index
+    built before for the same file and options can be passed in, the
+    one in use is kept in self.index.
+    """
+    _tables = {'DW_TAG_subprogram': 'funcs',
+               'DW_TAG_variable': 'var',
+               'DW_TAG_typedef': 'structs',
+               'DW_TAG_union_type': 'structs'}
+
+    def __init__(self, filename, exported=False, select=None, index=None):
+        self._file = elfFile(filename)
+        elffile = self._file.elffile
+        if not elffile.has_dwarf_info():
+            self._file.close()
+            raise ValueError(filename + ' has no DWARF info')
+        self.dwarfinfo = elffile.get_dwarf_info()
+        set_global_machine_arch(elffile.get_machine_arch())
+
+        self.DIEs = dieLookup(self.dwarfinfo)
+        self._memo = {}
+        self._baseTypes = lazyBaseTypes(self.DIEs, self._memo)
+        self._noname = itertools.count(1)
+        self._select = select
+
+        if index is None:
+            index = self._buildIndex(elffile, exported, select)
+        self.index = index
+
+        # pyelftools reads through one stream and the type memo is shared,
+        # so only one entry is parsed at a time
+        self._lock = threading.RLock()
+        # Closing any of the tables closes the file behind all of them
+        self.funcs = lazyTable(index['funcs'], self._func, self._lock, self.close)
+        self.var = lazyTable(index['var'], self._var, self._lock, self.close)
+        self.structs = lazyTable(index['structs'], self._struct, self._lock, self.close)
+
+    def _buildIndex(self, elffile, exported, select):
+        symbols = dynamicSymbols(elffile) if exported else None
+        index = {'funcs': OrderedDict(), 'var': OrderedDict(),
+                 'structs': OrderedDict()}
+        for CU in self.dwarfinfo.iter_CUs():
+            top = CU.get_top_DIE()
+            if select is not None and not select.unit(top):
+                continue
+            for DIE in top.iter_children():
+                if DIE.tag not in self._tables:
+                    continue
+                try:
+                    name = DIE.attributes['DW_AT_name'].value.decode()
+                except KeyError:
+                    continue
+                table = self._tables[DIE.tag]
+                if table != 'structs':
+                    if select is not None and not select.symbol(name):
+                        continue
+                    if symbols is not None and not self._exported(DIE, name, symbols):
+                        continue
+                index[table][name] = (CU.cu_offset, DIE.offset)
+        return index
+
+    @staticmethod
+    def _exported(DIE, name, symbols):
+        if name in symbols:
+            return True
+        try:
+            return DIE.attributes['DW_AT_linkage_name'].value.decode() in symbols
+        except KeyError:
+            return False
+
+    def _getDIE(self, loc):
+        cu_offset, offset = loc
+        cu = self.dwarfinfo.get_CU_at(cu_offset)
+        return self.dwarfinfo.get_DIE_from_refaddr(offset, cu)
+
+    def _finish(self, kind, x):
+        parseBT(self._baseTypes, {None: x})
+        return compactEntry(kind, cleanDict(x))
+
+    def _func(self, loc):
+        return self._finish('funcs', parseFunc(self._getDIE(loc), self._noname))
+
+    def _var(self, loc):
+        return self._finish('var', getAttr(self._getDIE(loc)))
+
+    def _struct(self, loc):
+        return self._finish('structs', parseStruct(self.DIEs, self._getDIE(loc), self._memo))
+
+    def tables(self):
+        return {'funcs':self.funcs, 'var':self.var, 'structs':self.structs}
+
+    def reachable(self):
+        """
+        Fully parsed tables of every function and variable in the index
+        and only the struct types they reach, or include names
+        """
+        funcs = OrderedDict(self.funcs.items())
+        var = OrderedDict(self.var.items())
+
+        todo = []
+        def visit(x):
+            if x is not None and (x.struct or x.union):
+                todo.append(x.type)
+        for f in funcs.values():
+            visit(f.type)
+            for arg in f.args.values():
+                visit(arg.type)
+        for v in var.values():
+            visit(v.type)
+        if self._select is not None:
+            todo.extend(k for k in self.structs.keys() if self._select.named(k))
+
+        found = {}
+        while todo:
+            name = todo.pop()
+            if name in found or name not in self.structs:
+                continue
+            found[name] = st = self.structs[name]
+            for arg in st.args.values():
+                visit(arg.type)
+
+        # Keep the DWARF order of the full table
+        structs = OrderedDict((k, found[k]) for k in self.structs.keys() if k in found)
+        return {'funcs':funcs, 'var':var, 'structs':structs}
+
+    def close(self):
+        self._file.close()
+
+
+def cuChunks(filename, nchunks):
+    # Split the CUs into at most nchunks contiguous runs of similar size
+    with elfFile(filename) as elffile:
+        if not elffile.has_dwarf_info():
+            raise ValueError(filename + ' has no DWARF info')
+        CUs = [(CU.cu_offset, CU.size) for CU in elffile.get_dwarf_info().iter_CUs()]
+
+    total = sum(size for offset, size in CUs)
+    chunks = [[]]
+    done = 0
+    for offset, size in CUs:
+        if chunks[-1] and done >= total * len(chunks) / float(nchunks):
+            chunks.append([])
+        chunks[-1].append(offset)
+        done += size
+    return chunks
+
+
+def _parseCUs(job):
+    filename, cu_offsets = job
+    noname = itertools.count(1)
+    res = parseDIE(process_file(filename, cu_offsets), noname)
+    return res, next(noname) - 1
+
+
+_nonameRe = re.compile(r'^NONAME(\d+)$')
+
+def _renumber(x, base):
+    res = OrderedDict()
+    for k, v in x.items():
+        m = _nonameRe.match(k)
+        if m:
+            k = 'NONAME%04d' % (int(m.group(1)) + base)
+        res[k] = v
+    return res
+
+
+def mergeParsed(parts):
+    # Merge per chunk parseDIE results in CU order. Unnamed entries are
+    # renumbered and later definitions replace earlier ones, the same as
+    # parseDIE does when it sees every CU itself. The parts are left as
+    # they are so they can be merged again.
+    res = {'funcs':OrderedDict(), 'var':OrderedDict(), 'structs':OrderedDict()}
+    base = 0
+    for x, used in parts:
+        if base:
+            x = {'var': _renumber(x['var'], base),
+                 'funcs': OrderedDict((name, f.replace(args=_renumber(f.args, base)))
+                                      for name, f in x['funcs'].items()),
+                 'structs': x['structs']}
+        for k in res:
+            for name, value in x[k].items():
+                res[k][name] = value
+        base += used
+    return res
+
+
+# Attributes parseDIE never looks at. They are left out of the CU
+# fingerprints, so code moving to new addresses or lines does not count
+# as a change.
+_volatileAttrs = set(['DW_AT_low_pc', 'DW_AT_high_pc', 'DW_AT_entry_pc',
+                      'DW_AT_ranges', 'DW_AT_location', 'DW_AT_frame_base',
+                      'DW_AT_decl_file', 'DW_AT_decl_line', 'DW_AT_decl_column',
+                      'DW_AT_call_file', 'DW_AT_call_line', 'DW_AT_call_column',
+                      'DW_AT_call_return_pc', 'DW_AT_call_pc', 'DW_AT_stmt_list',
+                      'DW_AT_GNU_macros', 'DW_AT_macros', 'DW_AT_producer',
+                      'DW_AT_comp_dir'])
+
+
+def cuFingerprint(DIEs):
+    h = hashlib.sha1()
+    for DIE in DIEs:
+        h.update(repr((DIE.tag, DIE.has_children)).encode())
+        for attr in itervalues(DIE.attributes):
+            if attr.name not in _volatileAttrs:
+                h.update(repr((attr.name, attr.form, attr.value)).encode())
+    return h.hexdigest()
+
+
+def _sectionBytes(sec, start=0, end=None):
+    if sec is None:
+        return b''
+    if end is None:
+        end = sec.size
+    sec.stream.seek(start)
+    return sec.stream.read(end - start)
+
+
+def cuRawKeys(dwarfinfo, CUs):
+    # Fingerprints of each CU's encoded DIEs, the abbreviations they are
+    # decoded with and the shared string sections, read without decoding
+    # any DIE. Any change shows up, including moved addresses.
+    strings = hashlib.sha1()
+    for sec in (dwarfinfo.debug_str_sec, dwarfinfo.debug_line_str_sec,
+                dwarfinfo.debug_str_offsets_sec):
+        strings.update(_sectionBytes(sec))
+    strings = strings.digest()
+
+    abbrev = dwarfinfo.debug_abbrev_sec
+    starts = sorted(set(CU['debug_abbrev_offset'] for CU in CUs))
+    ends = dict(zip(starts, starts[1:] + [abbrev.size]))
+
+    res = []
+    for CU in CUs:
+        h = hashlib.sha1(strings)
+        start = CU['debug_abbrev_offset']
+        h.update(_sectionBytes(abbrev, start, ends[start]))
+        h.update(_sectionBytes(dwarfinfo.debug_info_sec, CU.cu_offset,
+                               CU.cu_offset + CU.size))
+        res.append(h.hexdigest())
+    return res
+
+
+def parseIncremental(filename, parts=None):
+    """
+    Parse filename one CU at a time. parts holds the per CU results of an
+    earlier call. CUs whose encoded bytes are unchanged are reused without
+    decoding them, the others are decoded and only parsed again when
+    their DIEs differ in more than addresses and line numbers.
+
+    Returns the merged tables, the new parts and how many CUs were parsed.
+    """
+    if parts is None:
+        parts = {'units': {}, 'raw': {}}
+    units = {}
+    raws = {}
+    order = []
+    nparsed = 0
+
+    with elfFile(filename) as elffile:
+        if not elffile.has_dwarf_info():
+            raise ValueError(filename + ' has no DWARF info')
+        dwarfinfo = elffile.get_dwarf_info()
+        set_global_machine_arch(elffile.get_machine_arch())
+        CUs = list(dwarfinfo.iter_CUs())
+        for CU, raw in zip(CUs, cuRawKeys(dwarfinfo, CUs)):
+            key = parts['raw'].get(raw)
+            if key not in parts['units']:
+                DIEs = OrderedDict((DIE.offset, DIE) for DIE in CU.iter_DIEs())
+                key = cuFingerprint(DIEs.values())
+                if key not in units and key not in parts['units']:
+                    noname = itertools.count(1)
+                    res = parseDIE(DIEs, noname)
+                    units[key] = (res, next(noname) - 1)
+                    nparsed += 1
+            if key not in units:
+                units[key] = parts['units'][key]
+            raws[raw] = key
+            order.append(key)
+
+    return mergeParsed([units[k] for k in order]), {'units': units, 'raw': raws}, nparsed
+
+
+def parseDwarf(filename, cache=False, cache_dir=None, lazy=False, workers=None,
+               exported=False, include=None, exclude=None, sources=None):
+    select = None
+    if include is not None or exclude is not None or sources is not None:
+        select = symbolFilter(include, exclude, sources)
+
+    # Options changing the result are part of the cache key
+    options = []
+    if exported:
+        options.append(('exported', True))
+    if select is not None:
+        options.append(('select', select.key()))
+    options = tuple(options) or None
+
+    if lazy:
+        # Only the name -> DIE index is cached, entries are still parsed
+        # from the file on first access
+        if not cache:
+            return lazyDwarf(filename, exported, select).tables()
+        options = (options, 'lazy')
+        index = loadCache(filename, cache_dir, options)
+        d = lazyDwarf(filename, exported, select, index)
+        if index is None:
+            saveCache(filename, d.index, cache_dir, options)
+        return d.tables()
+
+    if cache:
+        res = loadCache(filename, cache_dir, options)
+        if res is not None:
+            return res
+
+    if exported or select is not None:
+        # Only the selected symbols and the types they reach are decoded,
+        # so there is nothing left to split over workers
+        d = lazyDwarf(filename, exported, select)
+        try:
+            res = d.reachable()
+        finally:
+            d.close()
+        if cache:
+            saveCache(filename, res, cache_dir, options)
+        return res
+
+    if workers is not None and workers > 1:
+        # Each process handles whole CUs, which assumes type references
+        # do not cross CUs (DW_FORM_ref_addr, as seen with LTO)
+        jobs = [(filename, c) for c in cuChunks(filename, 4 * workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            res = mergeParsed(pool.map(_parseCUs, jobs))
+    else:
+        DIEs =  process_file(filename)
+        res = parseDIE(DIEs)
+
+    if cache:
+        saveCache(filename, res, cache_dir, options)
+    return res
 
 
 
@@ -1,8 +1,22 @@
+import os
+import shutil
 import ctypes
+import tempfile
 import numpy as np
+import time
 import struct
+import asyncio
+import threading
+import logging
+import itertools
+import functools
 
-from .parsedwarf import parseDwarf
+from concurrent.futures import ThreadPoolExecutor
+
+from .parsedwarf import parseDwarf, parseIncremental
+from .callstats import callstats, timedCall
+from .registry import typeregistry
+from .descriptors import StructDesc
 
 
 _dictCTypes = {
@@ -45,19 +59,255 @@ _dictStTypes = {
         ('char',1): 'c',
         }
 
-_allStructsBase = {}
+# Stands in when no library's types are available
+_noTypes = typeregistry({})
+
+_log = logging.getLogger(__name__)
+
+_executor = None
+_executorLock = threading.Lock()
+
+def defaultExecutor():
+    # Shared pool for cfunc.submit/acall, made on first use
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(thread_name_prefix='pyctype')
+        return _executor
+
+def set_executor(executor):
+    """
+    Replace the thread pool used by cfunc.submit, cfunc.acall and
+    cwrap.run_many when no other executor was given
+    """
+    global _executor
+    with _executorLock:
+        _executor = executor
+
+_workerLibs = {}
+
+def init_worker(*libs):
+    """
+    Pool initializer for worker processes, e.g.
+    ProcessPoolExecutor(initializer=init_worker, initargs=(lib,)).
+    Each worker unpickles the parsed metadata instead of parsing the
+    library again, worker_lib returns the cwrap's in the worker.
+    """
+    for lib in libs:
+        _workerLibs[lib.filename] = lib
+
+def worker_lib(filename=None):
+    """
+    Returns the cwrap given to init_worker for filename, filename can be
+    left out when there is only one
+    """
+    if filename is None:
+        if len(_workerLibs) != 1:
+            raise KeyError('%d libraries in this worker, give a filename' % len(_workerLibs))
+        return next(iter(_workerLibs.values()))
+    return _workerLibs[filename]
+
+def fileStamp(filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def builtItems(table):
+    # Entries of a funcs/var table without parsing lazy ones
+    return getattr(table, '_data', table).items()
+
+
+def fullParse(options):
+    # Reload can only work per CU when every symbol was parsed
+    return not (options['lazy'] or options['exported'] or
+                any(options.get(k) is not None for k in ('include', 'exclude', 'sources')))
+
+
+def loadCopy(filename, directory=None):
+    # dlopen hands back the already loaded library for a path it has seen,
+    # so a rebuilt library is loaded from a private copy. The mapping
+    # outlives the unlinked file. The copy goes next to the library by
+    # default, temporary directories are often mounted noexec.
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(filename))
+    fd, path = tempfile.mkstemp(prefix='.pyctype_', dir=directory,
+                                suffix='_' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f, open(filename, 'rb') as src:
+            shutil.copyfileobj(src, f)
+        return ctypes.CDLL(path)
+    finally:
+        os.unlink(path)
+
 
 class cwrap(object):
-    def __init__(self, filename):
-        global _allStructsBase
+    def __init__(self, filename, cache=False, cache_dir=None, lazy=False,
+                 workers=None, instrument=False, executor=None, exported=False,
+                 reloadable=False, include=None, exclude=None, sources=None,
+                 copy_dir=None):
         self.filename = filename
+        # Where reload puts the copies it loads, None for next to filename
+        self._copyDir = copy_dir
+        self._stamp = fileStamp(filename)
         self._lib = ctypes.CDLL(filename)
+        self._callstats = callstats() if instrument else None
+        self._executor = executor
+        # Guards the lazy creation of cvar/cfunc objects
+        self._lock = threading.RLock()
+        self._watcher = None
+
+        self._parseOptions = {'cache': cache, 'cache_dir': cache_dir, 'lazy': lazy,
+                              'workers': workers, 'exported': exported,
+                              'include': include, 'exclude': exclude, 'sources': sources}
+        self._cuparts = None
+        if reloadable and fullParse(self._parseOptions):
+            # Keep the per CU results so reload only parses changed CUs
+            x, self._cuparts, n = parseIncremental(filename)
+        else:
+            x = parseDwarf(filename, **self._parseOptions)
+        self._setTables(x)
 
-        x = parseDwarf(filename)
+    def _setTables(self, x):
         self._funcs = x['funcs']
         self._var = x['var']
         self._structs = x['structs']
-        _allStructsBase = x['structs']
+        # Struct lookups are scoped to this library
+        self._types = typeregistry(x['structs'])
+
+    def _plainTables(self):
+        # Parsed descriptors without the cvar/cfunc objects made from them,
+        # lazy tables are parsed in full
+        funcs = dict((k, getattr(v, '_desc', v)) for k, v in self._funcs.items())
+        var = {}
+        for k, v in self._var.items():
+            v = getattr(v, '_desc', v)
+            # Entries _init_struct added
+            if not isinstance(v, StructDesc):
+                var[k] = v
+        structs = dict(self._structs.items())
+        return {'funcs': funcs, 'var': var, 'structs': structs}
+
+    def __getstate__(self):
+        # The CDLL, locks, executor and watcher thread stay behind, the
+        # library is opened again with the shipped metadata
+        return {'filename': self.filename, 'stamp': self._stamp,
+                'options': self._parseOptions, 'copy_dir': self._copyDir,
+                'instrument': self._callstats is not None,
+                'tables': self._plainTables()}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._stamp = fileStamp(self.filename)
+        self._lib = ctypes.CDLL(self.filename)
+        self._callstats = callstats() if state['instrument'] else None
+        self._executor = None
+        self._lock = threading.RLock()
+        self._watcher = None
+        self._parseOptions = state['options']
+        self._copyDir = state['copy_dir']
+        self._cuparts = None
+
+        if self._stamp != state['stamp']:
+            # Rebuilt since it was pickled, the metadata is stale
+            x = parseDwarf(self.filename, **self._parseOptions)
+        else:
+            x = state['tables']
+        self._setTables(x)
+
+    def reload(self, force=False):
+        """
+        Reload the library if the file changed since it was loaded.
+        Only changed compilation units are parsed again (from the second
+        reload on unless reloadable=True was given). cfunc and cvar objects
+        whose definition is unchanged are kept and rebound to the new
+        library, others are replaced. The new build is loaded from a copy
+        made in copy_dir, next to the library unless that was given.
+        Returns True if it was reloaded.
+        """
+        with self._lock:
+            stamp = fileStamp(self.filename)
+            if not force and stamp == self._stamp:
+                return False
+
+            lib = loadCopy(self.filename, self._copyDir)
+            if not fullParse(self._parseOptions):
+                x = parseDwarf(self.filename, **self._parseOptions)
+            else:
+                x, self._cuparts, self._reparsed = parseIncremental(self.filename,
+                                                                    self._cuparts)
+
+            # Only the objects already made, lazy entries stay unparsed
+            old = list(builtItems(self._funcs)) + list(builtItems(self._var))
+            tables = self._funcs
+            self._lib = lib
+            self._stamp = stamp
+            self._setTables(x)
+
+            for name, obj in old:
+                if isinstance(obj, cfunc):
+                    if name in self._funcs and self._funcs[name] == obj._desc:
+                        obj._rebind(lib, self._types)
+                        self._funcs[name] = obj
+                elif isinstance(obj, cvar):
+                    if name in self._var:
+                        desc = self._var[name]
+                    elif name in self._structs:
+                        desc = self._types[name]
+                    else:
+                        continue
+                    if desc == obj._desc:
+                        obj.__init__(lib, desc, name, self._types)
+                        self._var[name] = obj
+
+            # Lazy tables hold the ELF file they parse from open
+            close = getattr(tables, 'close', None)
+            if close is not None:
+                close()
+            return True
+
+    def watch(self, interval=1.0, callback=None, onerror=None):
+        """
+        Poll the library every interval seconds from a daemon thread and
+        reload it once it has changed and stopped changing. callback(self)
+        is called after each reload, onerror(self, exc) when a reload
+        fails, which is logged if onerror is not given.
+        """
+        self.unwatch()
+        stop = threading.Event()
+
+        def run():
+            seen = self._stamp
+            while not stop.wait(interval):
+                try:
+                    stamp = fileStamp(self.filename)
+                except OSError:
+                    # Removed while being rebuilt
+                    continue
+                # Wait for one unchanged poll so half written files are skipped
+                if stamp != self._stamp and stamp == seen:
+                    try:
+                        reloaded = self.reload()
+                    except Exception as e:
+                        reloaded = False
+                        if onerror is not None:
+                            onerror(self, e)
+                        else:
+                            _log.exception('Reloading %s failed', self.filename)
+                    if reloaded and callback is not None:
+                        callback(self)
+                seen = stamp
+
+        t = threading.Thread(target=run, name='pyctype-watch', daemon=True)
+        self._watcher = (stop, t)
+        t.start()
+
+    def unwatch(self):
+        if self._watcher is not None:
+            stop, t = self._watcher
+            stop.set()
+            if t is not threading.current_thread():
+                t.join()
+            self._watcher = None
 
     def __dir__(self):
         return list(self._var.keys()) + list(self._funcs.keys()) + list(self._structs.keys()) 
@@ -65,15 +315,80 @@ class cwrap(object):
     def _init_var(self, name):
         if hasattr(self._var[name],'_init'):
             return
-        
-        self._var[name] = cvar(self._lib, self._var[name], name)
+
+        with self._lock:
+            if not hasattr(self._var[name],'_init'):
+                self._var[name] = cvar(self._lib, self._var[name], name,
+                                       self._types)
 
 
     def _init_func(self, name):
         if hasattr(self._funcs[name],'_init'):
             return
 
-        self._funcs[name] = cfunc(self._lib, self._funcs[name], name)
+        with self._lock:
+            if not hasattr(self._funcs[name],'_init'):
+                self._funcs[name] = cfunc(self._lib, self._funcs[name], name,
+                                          self._callstats, self._executor,
+                                          self._types)
+
+    def set_executor(self, executor):
+        """
+        Use executor for this library's cfunc.submit/acall and run_many,
+        None goes back to the shared default pool
+        """
+        self._executor = executor
+        for f in self._funcs.values():
+            if isinstance(f, cfunc):
+                f.executor = executor
+
+    def run_many(self, calls, executor=None):
+        """
+        Run a batch of (name, args) calls concurrently on the thread pool,
+        returns the results in the same order. The GIL is released while
+        each call is in C. name may also be a cfunc.
+        """
+        futures = []
+        for name, args in calls:
+            f = name if isinstance(name, cfunc) else getattr(self, name)
+            futures.append(f.submit(*args, executor=executor))
+        return [fut.result() for fut in futures]
+
+    def instrument(self, enable=True):
+        """
+        Turn per function call timing on or off, functions already
+        in use switch over on their next call
+        """
+        if enable and self._callstats is None:
+            self._callstats = callstats()
+        elif not enable:
+            self._callstats = None
+
+        for f in self._funcs.values():
+            if isinstance(f, cfunc):
+                f._set_stats(self._callstats)
+
+    def stats(self):
+        """
+        Returns per function call counts and latencies (in seconds) for
+        the functions called while instrumented, busiest first
+        """
+        if self._callstats is None:
+            return {}
+        return self._callstats.as_dict()
+
+    def reset_stats(self):
+        if self._callstats is not None:
+            self._callstats.reset()
+
+    def dump_stats(self, filename=None):
+        """
+        Returns the call statistics as a JSON string, also written to
+        filename if given
+        """
+        if self._callstats is None:
+            return callstats().dump(filename)
+        return self._callstats.dump(filename)
 
     def _init_struct(self, name):
         if name in self._var:
@@ -81,7 +396,10 @@ class cwrap(object):
 
         # Insert struct into variable defintions so we unify
         # access through cvar
-        self._var[name] = cvar(self._lib, self._structs[name], name)
+        with self._lock:
+            if name not in self._var:
+                self._var[name] = cvar(self._lib, self._types[name], name,
+                                       self._types)
 
 
     def __getattr__(self, name):
@@ -117,15 +435,31 @@ class cwrap(object):
 
 
 class cvar(object):
-    def __init__(self, lib, var , name = None):
+    def __init__(self, lib, var , name = None, types = None):
         self.lib = lib
-        self.var = var['def']
-        self._ctype = makeCType(self.var)
+        self._desc = var
+        self.var = var.type
+        self._ctype = makeCType(self.var, types=types)
         self.name = name
         self._init = True
 
+        self._array = None
+        self._obj = None
         if self.name is not None:
-            self.in_dll()
+            # Resolve the symbol once, the in_dll object stays a view
+            # of the library's memory
+            self._obj = self.in_dll()
+            if self.var.array and self.var.type != 'char' \
+                and isinstance(self._obj, ctypes.Array) and not self.var.struct:
+                # Zero-copy view of the library's memory
+                self._array = np.ctypeslib.as_array(self._obj)
+            elif self.var.array and isinstance(self._ctype, cstruct):
+                self._array = self._struct_array()
+            if self._array is not None and self.var.const:
+                # Const data lives in read only pages
+                self._array.flags.writeable = False
+        self._read = self._make_read()
+        self._write = self._make_write()
 
     def from_param(self,obj):
         return self._ctype.from_param(obj)
@@ -142,60 +476,127 @@ class cvar(object):
     def in_dll(self):
         return self._ctype.in_dll(self.lib, self.name)
 
-    @property
-    def value(self):
-        x = self._ctype.in_dll(self.lib, self.name)
-        if x is None:
+    def _struct_array(self):
+        # Arrays of structs become zero-copy record arrays
+        shape = tuple(upper - lower + 1 for lower, upper in self.var.array)
+        if min(shape) < 1:
             return None
+        size = self.var.size * int(np.prod(shape))
+        x = (ctypes.c_char * size).in_dll(self.lib, self.name)
+        arr = np.frombuffer(x, dtype=self._ctype.dtype).reshape(shape)
+        return arr.view(np.recarray)
+
+    def _make_read(self):
+        x = self._obj
+        if self._array is not None:
+            arr = self._array
+            return lambda: arr
+
+        if x is None:
+            return lambda: None
 
         if hasattr(x,'value'):
-            return x.value
+            return lambda: x.value
+
+        # Pointers are dereferenced on every read as their target can change
+        nptrs = 0
+        t = type(x)
+        while issubclass(t, ctypes._Pointer):
+            t = t._type_
+            nptrs += 1
+        hasvalue = hasattr(t, 'value')
+
+        def read():
+            y = x
+            for i in range(nptrs):
+                y = y.contents
+            if hasvalue:
+                return y.value
+            return y
+
+        return read
+
+    def _make_write(self):
+        x = self._obj
+        if self.var.const:
+            def write(value):
+                raise AttributeError('Can not set const variable')
+        elif self._array is not None:
+            arr = self._array
+            def write(value):
+                arr[...] = value
+        elif hasattr(self._ctype,'contents'):
+            write = self._ctype
+        elif x is None:
+            def write(value):
+                raise AttributeError('Not a variable in the library')
         else:
-            while True:
-                try:
-                    x = x.contents
-                except AttributeError:
-                    break
-            if hasattr(x,'value'):
-                return x.value
-            else:
-                return x
+            def write(value):
+                x.value = value
+        return write
 
+    @property
+    def value(self):
+        return self._read()
 
     def set(self, value):
-        if self.var['const']:
-            raise AttributeError('Can not set const variable')
-        else:
-            if hasattr(self._ctype,'contents'):
-                self._ctype(value)
-            else:
-                self.in_dll().value = value
+        self._write(value)
 
     @property
     def _as_parameter_(self):
         return self._ctype._as_parameter_
 
 
+    def _cstruct(self):
+        if isinstance(self._ctype, cstruct):
+            return self._ctype
+        raise TypeError('Not a struct')
+
+    def to_dict(self):
+        return self._cstruct().to_dict()
+
+    def from_dict(self, values):
+        self._cstruct().from_dict(values)
+
+    @property
+    def dtype(self):
+        return self._cstruct().dtype
+
+    def as_array(self):
+        return self._cstruct().as_array()
+
+    def snapshot(self):
+        return self._cstruct().snapshot()
+
+    def restore(self, data):
+        self._cstruct().restore(data)
+
+    def diff(self, old, new=None):
+        return self._cstruct().diff(old, new)
+
+    def allocate(self, n):
+        return self._cstruct().allocate(n)
+
     def __getitem__(self, key):
-        if self.var['struct']:
+        if self.var.struct:
             return self._ctype[key]
         else:
             raise TypeError('Not subscriptable')
 
     def __setitem__(self, key, value):
-        if self.var['struct']:
+        if self.var.struct:
             self._ctype[key] = value
         else:
             raise TypeError('Not subscriptable')
 
     def __contains__(self, key):
-        if self.var['struct']:
+        if self.var.struct:
             return key in self._ctype
         else:
             raise TypeError('Not subscriptable')
 
     def __dir__(self):
-        if self.var['struct']:
+        if self.var.struct:
             return self._ctype.keys()
 
     def __repr__(self):
@@ -205,201 +606,350 @@ class cvar(object):
         return str(self.value)
 
     def __add__(self, other):
-        return getattr(self.value, '__add__')(other)
+        return getattr(self._read(), '__add__')(other)
 
     def __sub__(self, other):
-        return getattr(self.value, '__sub__')(other)
+        return getattr(self._read(), '__sub__')(other)
 
     def __mul__(self, other):
-        return getattr(self.value, '__mul__')(other)
+        return getattr(self._read(), '__mul__')(other)
 
     def __matmul__(self,other):
-        return getattr(self.value, '__matmul__')(other)
+        return getattr(self._read(), '__matmul__')(other)
 
     def __truediv__(self, other):
-        return getattr(self.value, '__truediv__')(other)
+        return getattr(self._read(), '__truediv__')(other)
         
     def __floordiv__(self,other):
-        return getattr(self.value, '__floordiv__')(other)
+        return getattr(self._read(), '__floordiv__')(other)
 
     def __pow__(self, other, modulo=None):
-        return getattr(self.value, '__pow__')(other,modulo)
+        return getattr(self._read(), '__pow__')(other,modulo)
 
     def __mod__(self,other):
-        return getattr(self.value, '__mod__')(other)        
+        return getattr(self._read(), '__mod__')(other)        
         
     def __lshift__(self,other):
-        return getattr(self.value, '__lshift__')(other)        
+        return getattr(self._read(), '__lshift__')(other)        
 
     def __rshift__(self,other):
-        return getattr(self.value, '__rshift__')(other)
+        return getattr(self._read(), '__rshift__')(other)
 
     def __and__(self,other):
-        return getattr(self.value, '__and__')(other)
+        return getattr(self._read(), '__and__')(other)
         
     def __xor__(self,other):
-        return getattr(self.value, '__xor__')(other)
+        return getattr(self._read(), '__xor__')(other)
         
     def __or__(self,other):
-        return getattr(self.value, '__or__')(other)
+        return getattr(self._read(), '__or__')(other)
         
     def __radd__(self, other):
-        return getattr(self.value, '__radd__')(other)
+        return getattr(self._read(), '__radd__')(other)
 
     def __rsub__(self, other):
-        return getattr(self.value, '__rsub__')(other)
+        return getattr(self._read(), '__rsub__')(other)
 
     def __rmul__(self, other):
-        return getattr(self.value, '__rmul__')(other)
+        return getattr(self._read(), '__rmul__')(other)
 
     def __rmatmul__(self,other):
-        return getattr(self.value, '__rmatmul__')(other)
+        return getattr(self._read(), '__rmatmul__')(other)
 
     def __rtruediv__(self, other):
-        return getattr(self.value, '__rtruediv__')(other)
+        return getattr(self._read(), '__rtruediv__')(other)
         
     def __rfloordiv__(self,other):
-        return getattr(self.value, '__rfloordiv__')(other)
+        return getattr(self._read(), '__rfloordiv__')(other)
 
     def __rpow__(self, other):
-        return getattr(self.value, '__rpow__')(other)
+        return getattr(self._read(), '__rpow__')(other)
 
     def __rmod__(self,other):
-        return getattr(self.value, '__rmod__')(other)        
+        return getattr(self._read(), '__rmod__')(other)        
         
     def __rlshift__(self,other):
-        return getattr(self.value, '__rlshift__')(other)        
+        return getattr(self._read(), '__rlshift__')(other)        
 
     def __rrshift__(self,other):
-        return getattr(self.value, '__rrshift__')(other)
+        return getattr(self._read(), '__rrshift__')(other)
 
     def __rand__(self,other):
-        return getattr(self.value, '__rand__')(other)
+        return getattr(self._read(), '__rand__')(other)
         
     def __rxor__(self,other):
-        return getattr(self.value, '__rxor__')(other)
+        return getattr(self._read(), '__rxor__')(other)
         
     def __ror__(self,other):
-        return getattr(self.value, '__ror__')(other)
+        return getattr(self._read(), '__ror__')(other)
 
     def __iadd__(self, other):
-        self.set(self.value + other)
-        return self.value
+        self._write(self._read() + other)
+        return self._read()
 
     def __isub__(self, other):
-        self.set(self.value - other)
-        return self.value
+        self._write(self._read() - other)
+        return self._read()
 
     def __imul__(self, other):
-        self.set(self.value * other)
-        return self.value
+        self._write(self._read() * other)
+        return self._read()
 
     def __itruediv__(self, other):
-        self.set(self.value / other)
-        return self.value
+        self._write(self._read() / other)
+        return self._read()
 
     def __ipow__(self, other, modulo=None):
-        x = self.value**other
+        x = self._read()**other
         if modulo:
             x = x % modulo
-        self.set(x)
-        return self.value
+        self._write(x)
+        return self._read()
 
     def __eq__(self, other):
-        return self.value == other
+        return self._read() == other
 
     def __neq__(self, other):
-        return self.value != other
+        return self._read() != other
 
     def __lt__(self, other):
-        return getattr(self.value, '__lt__')(other)
+        return getattr(self._read(), '__lt__')(other)
 
     def __le__(self, other):
-        return getattr(self.value, '__le__')(other)
+        return getattr(self._read(), '__le__')(other)
 
     def __gt__(self, other):
-        return getattr(self.value, '__gt__')(other)
+        return getattr(self._read(), '__gt__')(other)
 
     def __ge__(self, other):
-        return getattr(self.value, '__ge__')(other)
+        return getattr(self._read(), '__ge__')(other)
         
     def __format__(self, other):
-        return getattr(self.value, '__format__')(other)
+        return getattr(self._read(), '__format__')(other)
   
     def __bytes__(self):
-        return getattr(self.value, '__bytes__')()  
+        return getattr(self._read(), '__bytes__')()  
         
     def __bool__(self):
-        return getattr(self.value, '__bool__')()
+        return getattr(self._read(), '__bool__')()
    
     def __len__(self):
-        return getattr(self.value, '__len__')()
+        return getattr(self._read(), '__len__')()
 
 
 class cfunc(object):
-    def __init__(self, lib, func, name):
+    def __init__(self, lib, func, name, stats=None, executor=None, types=None):
         self.lib = lib
         self.name = name
-        try:
-            self.func = func['def']
-        except KeyError:
-            self.func = None
-        self._args = func['args']
+        self._desc = func
+        self._types = types
+        self.executor = executor
+        self._lock = threading.Lock()
+        self.func = func.type
+        self._args = func.args
+        self._stats = None if stats is None else stats.get(name)
+        self._call = self._first_call
+
+    def _rebind(self, lib, types):
+        # Same signature in a reloaded library, look the symbol up again
+        with self._lock:
+            self.lib = lib
+            self._types = types
+            self.__dict__.pop('_func', None)
+            self._call = self._first_call
+
+    def _set_stats(self, stats):
+        self._stats = None if stats is None else stats.get(self.name)
+        if '_func' in self.__dict__:
+            self._call = self._make_call(self._func)
 
-    def _init(self):
-        if '_func' not in self.__dict__:
-            self._func = getattr(self.lib, self.name)
-            try:
-                self._func.restype = makeCType(self.func) 
-            except KeyError:
-                self._func.restype = None
+    @property
+    def stats(self):
+        """
+        Call statistics for this function, None when not instrumented
+        """
+        if self._stats is None:
+            return None
+        return self._stats.as_dict()
 
-            # Set argtypes
-            self._ctype_args = [makeCType(value['def']) for key, value in self._args.items()]
-            self._func.argtypes = self._ctype_args
+    def _init(self):
+        if '_func' in self.__dict__:
+            return self._func
+
+        with self._lock:
+            if '_func' not in self.__dict__:
+                # Only publish _func once fully set up, other threads
+                # treat its presence as initialised
+                f = getattr(self.lib, self.name)
+                try:
+                    f.restype = makeCType(self.func, types=self._types)
+                except KeyError:
+                    f.restype = None
 
+                # Set argtypes
+                self._ctype_args = [makeCType(value.type, types=self._types)
+                                    for key, value in self._args.items()]
+                f.argtypes = self._ctype_args
+                self._call = self._make_call(f)
+                self._func = f
 
         return self._func
 
+    def _make_call(self, f):
+        # Specialise the call path for this signature once
+        convs = tuple(make_pointer_converter(value.type, argtype) if value.type.ptrs else None
+                        for value, argtype in zip(self._args.values(), self._ctype_args))
+
+        if self._stats is not None:
+            return timedCall(f, convs, self._stats)
+
+        if not any(convs):
+            # Nothing to convert, ctypes can be called directly
+            return f
+
+        def call(*args):
+            return f(*[a if c is None else c(a) for c, a in zip(convs, args)])
+
+        return call
+
+    def _first_call(self, *args):
+        self._init()
+        return self._call(*args)
+
     def __call__(self,*args):
+        return self._call(*args)
+
+    def submit(self, *args, executor=None):
+        """
+        Call the function on a thread pool, returns a
+        concurrent.futures.Future for the result
+
+        executor: Pool to use, defaults to the library's then the shared one
+        """
+        self._init()
+        if executor is None:
+            executor = self.executor or defaultExecutor()
+        return executor.submit(self._call, *args)
+
+    async def acall(self, *args, executor=None):
+        """
+        Await the function running on a thread pool, so long C calls do
+        not block the event loop
+        """
+        self._init()
+        if executor is None:
+            executor = self.executor or defaultExecutor()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self._call, *args))
+
+    def map(self, *args, out=None, chunksize=None):
+        """
+        Call the function element-wise over arrays, broadcasting across
+        the argument positions. Returns a NumPy array of the results.
+
+        out: Optional preallocated array for the results
+        chunksize: Number of elements converted at a time, bounds the
+                   temporary memory used for large inputs
+        """
         if '_func' not in self.__dict__:
             self._init()
 
-        a = []
-        for ain,atype in zip(args,self._args.values()):
-            if atype['def']['ptrs']:
-                a.append(make_pointer_argsvalues(ain, atype['def']))
+        if len(args) == 0 or len(args) != len(self._args):
+            raise TypeError('%s.map needs one array per argument (%d)' % (self.name, len(self._args)))
+
+        for atype in self._args.values():
+            if atype.type.ptrs:
+                raise TypeError('map only supports scalar arguments')
+
+        # Same rules as a single call, no silent float to int truncation
+        converted = []
+        for name, a, t in zip(self._args, args, self._ctype_args):
+            a = np.asarray(a)
+            dtype = np.dtype(t)
+            if not np.can_cast(a.dtype, dtype, casting='same_kind'):
+                raise TypeError('%s.map argument %s: can not convert %s to %s'
+                                % (self.name, name, a.dtype, dtype))
+            converted.append(a.astype(dtype, copy=False))
+        arrays = np.broadcast_arrays(*converted)
+        shape = arrays[0].shape
+        size = arrays[0].size
+
+        if self._func.restype is None:
+            dtype = None
+        else:
+            dtype = np.dtype(self._func.restype)
+            if out is None:
+                out = np.empty(shape, dtype=dtype)
+            elif out.shape != shape:
+                raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+
+        if chunksize is None or chunksize < 1:
+            chunksize = max(size, 1)
+
+        # The loop itself runs in C through starmap, each element only
+        # passes through the ctypes argument conversion. With stats on each
+        # chunk counts as stop - start calls.
+        f = self._func
+        stats = self._stats
+        clock = time.perf_counter
+        for start in range(0, size, chunksize):
+            stop = min(start + chunksize, size)
+            t0 = clock()
+            cols = [a.flat[start:stop].tolist() for a in arrays]
+            t1 = clock()
+            res = itertools.starmap(f, zip(*cols))
+            if dtype is None:
+                for i in res:
+                    pass
             else:
-                a.append(ain)
+                out.flat[start:stop] = np.fromiter(res, dtype=dtype, count=stop - start)
+            if stats is not None:
+                stats.add(t1 - t0, clock() - t1, stop - start)
 
-        return self._func(*a)
+        return out
 
+    def vectorize(self, chunksize=None):
+        """
+        Returns a function which applies map to its arguments
+        """
+        return functools.partial(self.map, chunksize=chunksize)
 
-def makeCType(x,ptrs=True):
-    res = None
-    try:
-        res = _dictCTypes[(x['type'],x['size'])]
-    except TypeError:
+
+def makeCType(x,ptrs=True,types=None):
+    if x is None:
         return None
-    except KeyError:
-        pass
+    res = _dictCTypes.get((x.type,x.size))
 
-    if x['struct']:
-        res = cstruct(_allStructsBase[x['type']])
+    if x.struct:
+        if types is None:
+            types = _noTypes
+        res = cstruct(types[x.type], types)
 
-    if ptrs and x['ptrs']>0:
+    if ptrs and x.ptrs>0:
         res = make_pointer_argtypes(res, x)
+    elif x.array and isinstance(res, type):
+        res = make_array_type(res, x)
+
+    return res
+
 
+def make_array_type(value, cctype):
+    # Arrays with an unknown bound are left as their element type
+    res = value
+    for lower, upper in reversed(cctype.array):
+        if upper < lower:
+            return value
+        res = res * (upper - lower + 1)
     return res
 
 
 def make_pointer_argtypes(value, cctype):
-    if cctype['ptrs']>0:
-        if cctype['struct']:
+    if cctype.ptrs>0:
+        if cctype.struct:
             res = ctypes.POINTER(value._bufferType)
-            nptrs = cctype['ptrs'] - 1
+            nptrs = cctype.ptrs - 1
         else:
-            nptrs = cctype['ptrs']
+            nptrs = cctype.ptrs
             res = value
         
         if nptrs > 0:
@@ -408,13 +958,139 @@ def make_pointer_argtypes(value, cctype):
 
     return res
 
+def make_pointer_converter(cctype, argtype=None):
+    if cctype.struct and cctype.ptrs == 1:
+        # Common case of passing a struct by reference, cvar's hold a
+        # cstruct while cstruct views and arenas hold the buffer themselves
+        def convert(value):
+            try:
+                return ctypes.byref(value._ctype._buffer)
+            except AttributeError:
+                return ctypes.byref(value._buffer)
+        return convert
+    if not cctype.struct and argtype is not None and cctype.ptrs in (1, 2):
+        return make_buffer_converter(cctype, argtype)
+    return functools.partial(make_pointer_argsvalues, cctype=cctype)
+
+
+def _asBuffer(value):
+    # NumPy arrays are used as is, other buffer protocol objects (memoryview,
+    # bytes, bytearray, array.array, ...) are viewed without a copy
+    if isinstance(value, np.ndarray):
+        return value
+    try:
+        return np.asarray(memoryview(value))
+    except TypeError:
+        return None
+
+
+# Simple types holding a pointer rather than a value
+_pointerCTypes = (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_wchar_p)
+
+def make_buffer_converter(cctype, argtype):
+    # Pointers to scalars take NumPy arrays and buffer objects, whose data
+    # pointer is passed straight through after checking the dtype,
+    # layout and writability against the DWARF type. Pointers to pointers
+    # take a 2D array or a sequence of 1D ones as a table of row pointers.
+    nptrs = cctype.ptrs
+    void = argtype is ctypes.c_void_p
+    base = argtype
+    for i in range(nptrs):
+        if isinstance(base._type_, str):
+            break
+        base = base._type_
+    # Untyped (void) data is taken as it is
+    dtype = None if base is ctypes.c_void_p else np.dtype(base)
+    # char * takes any single byte data
+    anybyte = base is ctypes.c_char
+    # Only const on the pointed to data allows read only buffers
+    writable = not cctype.pconst
+
+    def check(arr):
+        if dtype is not None and arr.dtype != dtype and \
+                not (anybyte and arr.dtype.itemsize == 1):
+            raise TypeError('Expected %s data got %s' % (dtype, arr.dtype))
+        if writable and not arr.flags.writeable:
+            raise ValueError('Read only buffer passed as a non-const pointer')
+
+    def pointer(arr):
+        check(arr)
+        if not arr.flags.c_contiguous:
+            raise ValueError('Buffer must be C contiguous')
+        if void:
+            return arr.ctypes.data
+        return arr.ctypes.data_as(argtype)
+
+    def table(value):
+        if isinstance(value, np.ndarray) and value.ndim == 2:
+            check(value)
+            if value.strides[1] != value.itemsize:
+                raise ValueError('Rows must be contiguous')
+            rows = (value.ctypes.data + value.strides[0] *
+                    np.arange(value.shape[0], dtype=np.intp)).astype(np.uintp)
+            keep = value
+        else:
+            arrs = [_asBuffer(row) for row in value]
+            rows = []
+            for arr in arrs:
+                if arr is None:
+                    raise TypeError('Expected a 2D array or a sequence of buffers')
+                check(arr)
+                if not arr.flags.c_contiguous:
+                    raise ValueError('Buffer must be C contiguous')
+                rows.append(arr.ctypes.data)
+            rows = np.array(rows, dtype=np.uintp)
+            keep = arrs
+        res = rows.ctypes.data_as(argtype)
+        # Rows must outlive the call
+        res._keep = keep
+        return res
+
+    def convert(value):
+        if value is None or isinstance(value, (ctypes._Pointer, ctypes.Array)):
+            return value
+        if isinstance(value, cvar):
+            if value._array is not None:
+                value = value._array
+            elif isinstance(value._obj, ctypes._SimpleCData):
+                value = value._obj
+            else:
+                return value._obj
+        if isinstance(value, ctypes._SimpleCData):
+            if nptrs == 1 and isinstance(value, _pointerCTypes):
+                # Already a pointer, its value is passed
+                if void:
+                    return ctypes.cast(value, ctypes.c_void_p).value
+                return ctypes.cast(value, argtype)
+            # Pointer to the caller's ctypes object, writes are seen
+            return ctypes.byref(value)
+        if void and isinstance(value, int) and not isinstance(value, bool):
+            # Address, as void * results are returned
+            return value
+
+        if nptrs == 2:
+            if not isinstance(value, (int, float, bytes, str)):
+                return table(value)
+        else:
+            arr = _asBuffer(value)
+            if arr is not None:
+                return pointer(arr)
+
+        if nptrs == 1 and not void and isinstance(value, (int, float, bool)):
+            # Pointer to a temporary holding a Python scalar
+            return ctypes.byref(base(value))
+        raise TypeError('Can not pass %s as %s' % (type(value).__name__, argtype.__name__))
+
+    return convert
+
+
 def make_pointer_argsvalues(value, cctype):
-    if cctype['ptrs']>0:
-        if cctype['struct']:
+    if cctype.ptrs>0:
+        if cctype.struct:
             res = ctypes.pointer(value._ctype._buffer)
-            nptrs = cctype['ptrs'] - 1
+            nptrs = cctype.ptrs - 1
         else:
-            nptrs = cctype['ptrs']
+            nptrs = cctype.ptrs
             res = value
         
         if nptrs > 0:
@@ -424,59 +1100,367 @@ def make_pointer_argsvalues(value, cctype):
     return res
 
 
-class cstruct(ctypes.Structure):
-    def __init__(self, structType):
-        self._structType = structType
-        self._args = self._structType['args']
+_structLayouts = {}
+
+def _memberSize(adef):
+    if adef.ptrs > 0:
+        size = ctypes.sizeof(ctypes.c_void_p)
+    else:
+        size = adef.size
+    if adef.array:
+        for lower, upper in adef.array:
+            size *= upper - lower + 1
+    return size
+
+
+def _parseArg(arg):
+    start = arg.loc
+    adef =  arg.type
+    end = start + _memberSize(adef)
+
+    # Aggregates are left without a format, see _memberView
+    if adef.array:
+        return start, end, ''
+
+    if adef.ptrs > 0:
+        return start, end, '@P'
+
+    typeTuple = (adef.type,adef.size)
+    sc = ''
+    if typeTuple in _dictStTypes:
+        sc = '@'+_dictStTypes[typeTuple]
+
+    return start, end, sc
+
+
+def _nestedType(adef, types):
+    # Struct or union definition of a member embedded by value
+    if adef.ptrs == 0 and (adef.struct or adef.union) and adef.type in types:
+        res = types[adef.type]
+        if res.args:
+            return res
+    return None
+
+
+def _memberView(adef, types):
+    # Returns a function making a zero-copy view of an aggregate member
+    # from (buffer, offset), and the nested struct definition if it is one
+    if adef.ptrs == 0 and not adef.array:
+        nested = _nestedType(adef, types)
+        if nested is None:
+            return None, None
+        def view(buffer, offset):
+            return cstruct(nested, types, buffer, offset)
+        return view, nested
+
+    dtype = _memberDtype(adef, types)
+    if dtype.subdtype is None:
+        # Arrays of unknown size
+        return None, None
+    base, shape = dtype.subdtype
+    rec = base.names is not None
+    def view(buffer, offset):
+        arr = np.ndarray(shape, base, buffer, offset)
+        if rec:
+            return arr.view(np.recarray)
+        return arr
+    return view, None
+
+
+def resolvePath(layout, path, types):
+    # Turns 'a.b.c' into a single layout entry at the absolute offset
+    entry = None
+    base = 0
+    for part in path.split('.'):
+        if entry is not None:
+            base += entry[1]
+            nested = entry[4]
+            if nested is None:
+                raise KeyError("No key "+str(path))
+            layout = compileStruct(nested, types)[0]
+        try:
+            entry = layout[part]
+        except KeyError:
+            raise KeyError("No key "+str(path))
+    st, start, end, view, nested = entry
+    return (st, base + start, base + end, view, nested)
+
+
+def _compileBulk(layout, size):
+    # One struct.Struct spanning the whole struct. Scalar fields get their
+    # own item, everything between them (padding, aggregates, overlapping
+    # union members) is carried as raw bytes so packing never clobbers it.
+    fields = sorted((entry[1], key, entry[0]) for key, entry in layout.items()
+                    if entry[0] is not None)
+    fmt = ['@']
+    keys = []
+    rest = []
+    pos = 0
+    for start, key, st in fields:
+        if start < pos:
+            rest.append(key)
+            continue
+        if start > pos:
+            fmt.append('%ds' % (start - pos))
+            keys.append(None)
+        fmt.append(st.format[1:])
+        keys.append(key)
+        pos = start + st.size
+    if size > pos:
+        fmt.append('%ds' % (size - pos))
+        keys.append(None)
+
+    bulk = struct.Struct(''.join(fmt))
+    if bulk.size != size:
+        # Packed or otherwise unusual layout, use the per field accessors
+        return tuple(), None, [key for start, key, st in fields], {}
+    # Position of each scalar in the packed values
+    index = dict((k, i) for i, k in enumerate(keys) if k is not None)
+    return tuple(keys), bulk, rest, index
+
+
+def _bitfield(name):
+    # Bitfields share bytes with their neighbours and have no byte offset
+    # of their own, so they can not be read or written as a whole
+    def view(buffer, offset):
+        raise TypeError('Bitfield member %s is not supported' % name)
+    return view
+
+
+def compileStruct(structType, types=None):
+    # Compiled once per struct definition and shared between all cstruct's
+    # of that type. Returns the per field layout, key -> (struct.Struct,
+    # start, end, view, nested struct), the whole struct (keys,
+    # struct.Struct, other keys, key -> position) and the entries by key
+    # including the dotted paths resolved so far.
+    if types is None:
+        types = _noTypes
+    # Shared by every library resolving the same nested types
+    key = types.identity(structType)
+    try:
+        return _structLayouts[key]
+    except KeyError:
+        pass
 
-        self._bufferType = ctypes.c_char * structType['def']['size']
-        self._buffer = self._bufferType()
-        self._init = True
+    layout = {}
+    for name, arg in structType.args.items():
+        if arg.bits is not None or arg.loc is None:
+            layout[name] = (None, arg.loc or 0, arg.loc or 0, _bitfield(name), None)
+            continue
+        start, end, sc = _parseArg(arg)
+        if sc:
+            layout[name] = (struct.Struct(sc), start, end, None, None)
+        else:
+            view, nested = _memberView(arg.type, types)
+            layout[name] = (None, start, end, view, nested)
 
-    def __getitem__(self, key):
-        if not key in self.keys():
-            raise KeyError("No key "+str(key))
+    res = (layout, _compileBulk(layout, structType.type.size), dict(layout))
+    _structLayouts[key] = res
+    return res
 
-        return self._unpack(key)
-        
 
-    def __setitem__(self, key, value):
-        if not key in self.keys():
-            raise KeyError("No key "+str(key))
+_structDtypes = {}
+
+def _memberDtype(adef, types):
+    if adef.ptrs > 0:
+        res = np.dtype(np.uintp)
+    elif (adef.struct or adef.union) and adef.type in types and \
+            types[adef.type].args:
+        res = structDtype(types[adef.type], types)
+    elif (adef.type, adef.size) in _dictStTypes:
+        res = np.dtype(_dictStTypes[(adef.type, adef.size)])
+    else:
+        # Unknown types are kept as opaque bytes
+        res = np.dtype('V%d' % max(adef.size, 1))
+
+    if adef.array:
+        shape = tuple(upper - lower + 1 for lower, upper in adef.array)
+        if min(shape) > 0:
+            res = np.dtype((res, shape))
+    return res
 
-        self._pack(key, value)
 
-    def _parseArg(self, key):
-        arg = self._args[key]
-        abytes = b''
+def structDtype(structType, types=None):
+    # NumPy dtype with the same offsets and itemsize as the C struct,
+    # nested struct members are looked up in types. The cache is shared
+    # by libraries resolving the same nested types.
+    if types is None:
+        types = _noTypes
+    ident = types.identity(structType)
+    try:
+        return _structDtypes[ident]
+    except KeyError:
+        pass
 
-        start = arg['loc'] 
-        adef =  arg['def']
-        end = start + adef['size']
+    names = []
+    formats = []
+    offsets = []
+    for key, arg in structType.args.items():
+        if arg.bits is not None or arg.loc is None:
+            # Bitfields have no NumPy equivalent
+            continue
+        names.append(key)
+        formats.append(_memberDtype(arg.type, types))
+        offsets.append(arg.loc)
+
+    res = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                    'itemsize': structType.type.size})
+    _structDtypes[ident] = res
+    return res
 
-        if adef['struct'] or adef['union']:
-            pass
-        
-        if adef['array']:
-            pass
-        
-        if adef['ptrs'] > 0:
-            pass
 
-        typeTuple = (adef['type'],adef['size'])
-        sc = ''
-        if typeTuple in _dictStTypes:
-            sc = '@'+_dictStTypes[typeTuple]
+class cstruct(ctypes.Structure):
+    def __init__(self, structType, types=None, buffer=None, offset=0):
+        self._structType = structType
+        self._types = types
+        self._args = self._structType.args
+        self._layout, self._bulk, self._paths = compileStruct(structType, types)
+
+        self._bufferType = ctypes.c_char * structType.type.size
+        if buffer is None:
+            self._buffer = self._bufferType()
+        else:
+            # View of a member of an enclosing struct
+            self._buffer = self._bufferType.from_buffer(buffer, offset)
+        self._init = True
+
+    def _entry(self, key):
+        # Dotted paths are resolved once per struct type
+        if not isinstance(key, str) or '.' not in key:
+            raise KeyError("No key "+str(key))
+        res = self._paths[key] = resolvePath(self._layout, key, self._types)
+        return res
 
-        return start, end, sc
+    def __getitem__(self, key):
+        try:
+            st, start, end, view, nested = self._paths[key]
+        except KeyError:
+            st, start, end, view, nested = self._entry(key)
+        if st is None:
+            if view is None:
+                raise TypeError("Can not access member "+str(key))
+            return view(self._buffer, start)
 
-    def _unpack(self, key):
-        start, end, sc = self._parseArg(key)
-        return struct.unpack(sc, self._buffer[start:end])[0]
+        return st.unpack_from(self._buffer, start)[0]
 
-    def _pack(self, key, value):
-        start, end, sc = self._parseArg(key)
-        struct.pack_into(sc, self._buffer, start, value)
+    def __setitem__(self, key, value):
+        try:
+            st, start, end, view, nested = self._paths[key]
+        except KeyError:
+            st, start, end, view, nested = self._entry(key)
+        if st is None:
+            if view is None:
+                raise TypeError("Can not access member "+str(key))
+            x = view(self._buffer, start)
+            if nested is None:
+                x[...] = value
+            elif isinstance(value, dict):
+                x.from_dict(value)
+            else:
+                x.restore(value.snapshot() if hasattr(value, 'snapshot') else value)
+            return
+
+        st.pack_into(self._buffer, start, value)
+
+    def to_dict(self):
+        """
+        Returns every scalar member, read with a single unpack
+        """
+        keys, bulk, rest, index = self._bulk
+        res = {}
+        if bulk is not None:
+            for k, v in zip(keys, bulk.unpack_from(self._buffer)):
+                if k is not None:
+                    res[k] = v
+        for k in rest:
+            res[k] = self[k]
+        return res
+
+    def from_dict(self, values):
+        """
+        Sets the scalar members found in values with a single pack,
+        members not in values keep their current value
+        """
+        if len(values) == 1:
+            # Cheaper than unpacking and packing the whole struct
+            for k, v in values.items():
+                self[k] = v
+            return
+
+        keys, bulk, rest, index = self._bulk
+        other = None
+        if bulk is not None:
+            current = list(bulk.unpack_from(self._buffer))
+            for k, v in values.items():
+                try:
+                    current[index[k]] = v
+                except KeyError:
+                    if other is None:
+                        other = []
+                    other.append(k)
+        else:
+            other = list(values)
+
+        # Members set one by one: overlapping union members, nested
+        # structs, arrays, or every member of unusual layouts
+        if other is not None:
+            for k in other:
+                if k not in self._layout:
+                    raise KeyError("No key "+str(k))
+        if bulk is not None:
+            bulk.pack_into(self._buffer, 0, *current)
+        if other is not None:
+            for k in other:
+                self[k] = values[k]
+
+    def snapshot(self):
+        """
+        Returns a copy of the raw bytes of the struct
+        """
+        return self._buffer.raw
+
+    def restore(self, data):
+        """
+        Overwrites the struct with bytes from snapshot()
+        """
+        if len(data) != len(self._buffer):
+            raise ValueError('Expected %d bytes got %d' % (len(self._buffer), len(data)))
+        memoryview(self._buffer).cast('B')[:] = data
+
+    def diff(self, old, new=None):
+        """
+        Returns the members whose bytes differ between two snapshots,
+        new defaults to the current contents
+        """
+        if new is None:
+            new = self.snapshot()
+        return [key for key in self.keys()
+                if old[self._layout[key][1]:self._layout[key][2]] !=
+                   new[self._layout[key][1]:self._layout[key][2]]]
+
+    @property
+    def dtype(self):
+        return structDtype(self._structType, self._types)
+
+    def as_array(self):
+        """
+        Zero-copy record array, of length 1, over the struct
+        """
+        return np.frombuffer(self._buffer, dtype=self.dtype).view(np.recarray)
+
+    def allocate(self, n):
+        """
+        Returns a carena of n instances of this struct type in one
+        contiguous buffer
+        """
+        return carena(self, n)
+
+    def _view(self, buffer):
+        # Same type as self over another buffer, skips the layout lookups
+        res = cstruct.__new__(cstruct)
+        res.__dict__.update(self.__dict__)
+        res._buffer = buffer
+        return res
 
     def keys(self):
         return self._args.keys()
@@ -500,4 +1484,108 @@ class cstruct(ctypes.Structure):
 
     @property
     def _as_parameter_(self):
-        return self._buffer
\ No newline at end of file
+        return self._buffer
+
+
+def _alignedBuffer(size, align=16):
+    # ctypes only guarantees the alignment of its own types, so the buffer
+    # is over allocated and viewed from the first aligned byte
+    raw = (ctypes.c_char * (size + align - 1))()
+    offset = -ctypes.addressof(raw) % align
+    return (ctypes.c_char * size).from_buffer(raw, offset)
+
+
+class carena(object):
+    """
+    Fixed number of instances of one struct type carved out of a single
+    contiguous, aligned buffer. Items are zero-copy cstruct views, the
+    arena itself is passed to C as a pointer to its first element.
+    """
+    def __init__(self, proto, n):
+        size = proto._structType.type.size
+        if not size:
+            raise TypeError('Can not allocate an incomplete struct')
+        if n < 1:
+            raise ValueError('Arena needs at least one instance')
+        self._proto = proto
+        self._size = size
+        self._n = n
+        self._data = _alignedBuffer(size * n)
+        self._base = ctypes.addressof(self._data)
+        # Indexing gives each slot's buffer sharing the arena's memory
+        self._slots = (proto._bufferType * n).from_buffer(self._data)
+        self._buffer = self._slots[0]
+        # Free slots, lowest index is handed out first
+        self._free = list(range(n - 1, -1, -1))
+        # Slots handed out by new and not freed yet
+        self._used = bytearray(n)
+        # Slots can be written through indexing, as_array or C at any
+        # time, so new always clears them, through a memoryview as that is
+        # cheaper than a ctypes.memset call
+        self._mem = memoryview(self._data).cast('B')
+        self._zero = bytes(size)
+        # Views are made on first access and reused
+        self._views = [None] * n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError('Arena index out of range')
+        res = self._views[i]
+        if res is None:
+            res = self._views[i] = self._proto._view(self._slots[i])
+        return res
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self[i]
+
+    @property
+    def available(self):
+        return len(self._free)
+
+    def new(self):
+        """
+        Returns a zeroed instance from the free slots
+        """
+        try:
+            i = self._free.pop()
+        except IndexError:
+            raise MemoryError('Arena of %d instances is full' % self._n)
+        start = i * self._size
+        self._mem[start:start + self._size] = self._zero
+        self._used[i] = 1
+        res = self._views[i]
+        if res is None:
+            res = self._views[i] = self._proto._view(self._slots[i])
+        return res
+
+    def free(self, item):
+        """
+        Puts an instance returned by new back on the free slots
+        """
+        i, rem = divmod(ctypes.addressof(item._buffer) - self._base, self._size)
+        if rem or not 0 <= i < self._n:
+            raise ValueError('Instance is not part of this arena')
+        if not self._used[i]:
+            raise ValueError('Instance is not in use')
+        self._used[i] = 0
+        self._free.append(i)
+
+    def as_array(self):
+        """
+        Zero-copy record array over the whole arena
+        """
+        arr = np.frombuffer(self._data, dtype=self._proto.dtype)
+        return arr.view(np.recarray)
+
+    def from_param(self, obj):
+        return self._buffer
+
+    @property
+    def _as_parameter_(self):
+        return self._buffer
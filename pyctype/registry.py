@@ -0,0 +1,91 @@
+from __future__ import print_function
+
+import threading
+
+# Struct definitions shared by every loaded library, keyed on their full
+# contents so identical types from common headers are only held once
+_interned = {}
+_internLock = threading.Lock()
+
+
+def intern(key, value):
+    with _internLock:
+        return _interned.setdefault(key, value)
+
+
+class resolvedType(object):
+    """
+    Identity of a struct definition together with the nested types it
+    embeds. Compiled layouts and dtypes are keyed on it, equal definitions
+    embedding different nested types get different ones.
+    """
+    __slots__ = ['struct', 'deps']
+
+    def __init__(self, struct, deps):
+        self.struct = struct
+        self.deps = deps
+
+
+class typeregistry(object):
+    """
+    Struct types of one library, resolved by name. Lookups never see
+    another library's definitions, but equal definitions are interned so
+    compiled layouts and dtypes are shared between libraries.
+    """
+    def __init__(self, structs):
+        self._source = structs
+        self._resolved = {}
+        # struct definition -> resolvedType
+        self._identity = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self._source
+
+    def __getitem__(self, name):
+        try:
+            return self._resolved[name].struct
+        except KeyError:
+            pass
+
+        with self._lock:
+            return self._intern(name, ()).struct
+
+    def identity(self, st):
+        """
+        Returns the resolvedType of a definition this registry handed out
+        """
+        try:
+            return self._identity[st]
+        except KeyError:
+            pass
+        # Not from this registry, only shared with itself
+        return (st, self)
+
+    def _intern(self, name, stack):
+        try:
+            return self._resolved[name]
+        except KeyError:
+            pass
+
+        st = self._source[name]
+
+        # Members embedded by value are part of the layout, so equal
+        # definitions also need equal nested types
+        deps = []
+        for arg in st.args.values():
+            d = arg.type
+            if d is None or not (d.struct or d.union) or d.ptrs or d.type == name:
+                continue
+            if d.type in stack or d.type not in self._source:
+                continue
+            deps.append(id(self._intern(d.type, stack + (name,))))
+
+        key = (st, tuple(deps))
+        res = intern(key, resolvedType(*key))
+        self._resolved[name] = res
+        self._identity.setdefault(st, res)
+        return res
+
+    def keys(self):
+        return self._source.keys()
@@ -1,7 +1,28 @@
-import pyctype as pyc
-import ctypes
+from __future__ import print_function
 
-x=pyc.cwrap('./tests/libtester.so')
-y = x.setStructS1()
+import sys
+import argparse
 
+from .generate import generate
 
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyctype',
+                                     description='Auto generate ctype bindings')
+    sub = parser.add_subparsers(dest='command')
+
+    gen = sub.add_parser('generate', help='Write a static ctypes binding module')
+    gen.add_argument('library', help='Shared library with DWARF debug info')
+    gen.add_argument('-o', '--output', default=None,
+                     help='Output file (default: stdout)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        src = generate(args.library, args.output)
+        if args.output is None:
+            sys.stdout.write(src)
+    else:
+        parser.print_help()
+        return 1
+    return 0
@@ -23,9 +23,11 @@ setup(name='pyAutoCtype',
       url='https://github.com/rjfarmer/pyAutoCtype',
       keywords='python ctypes binding',
       packages=find_packages(),
+      python_requires='>=3.7',
       classifiers=[
 			"Development Status :: 3 - Alpha",
 			"License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)",
+			"Programming Language :: Python :: 3 :: Only",
 		    'Topic :: Software Development :: Code Generators'
       ],
       test_suite = 'tests'
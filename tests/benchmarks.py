@@ -0,0 +1,756 @@
+"""
+Performance benchmarks for pyctype, these are not run as part of the test suite.
+
+Usage:
+    python tests/benchmarks.py [benchmark ...] [--json results.json]
+
+Each benchmark builds whatever C library it needs with gcc in a temporary
+directory and prints its timings. With --json every measurement is also
+written out, together with the environment it was taken in, so runs can
+be compared to track regressions.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import asyncio
+import json
+import pickle
+import time
+import timeit
+import ctypes
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pyctype as pyc
+
+
+def compileLib(source, tmpdir, name='libbench'):
+    src = os.path.join(tmpdir, name + '.c')
+    lib = os.path.join(tmpdir, name + '.so')
+    with open(src, 'w') as f:
+        f.write(source)
+    subprocess.check_output(['gcc', '-ggdb3', '-fPIC', '-shared', '-o', lib, src])
+    return lib
+
+
+def bestOf(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        func()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def genTypedefChains(nchains, depth):
+    # Every chain is depth typedefs deep and ends in a struct, each level
+    # is then used by a global, a struct member and a function argument
+    lines = []
+    for i in range(nchains):
+        lines.append('typedef struct { int a; double b; } c%d_0;' % i)
+        for j in range(1, depth):
+            lines.append('typedef c%d_%d c%d_%d;' % (i, j - 1, i, j))
+        lines.append('typedef struct {')
+        for j in range(depth):
+            lines.append('    c%d_%d m%d;' % (i, j, j))
+        lines.append('} s%d;' % i)
+        for j in range(depth):
+            lines.append('c%d_%d g%d_%d;' % (i, j, i, j))
+        lines.append('int f%d(s%d *x, c%d_%d y){ return 0; }' % (i, i, i, depth - 1))
+    return '\n'.join(lines) + '\n'
+
+
+def genLibrary(nfuncs, nstructs, nglobals, ninternal=0):
+    # A library shaped like a large simulation code: many small functions,
+    # struct types with pointer and array members and plain globals, plus
+    # optional hidden helpers with their own types that are not exported
+    lines = ['#include <stdlib.h>']
+    for i in range(ninternal):
+        lines.append('typedef struct { int a; double b; } ist%d;' % i)
+        lines.append('__attribute__((visibility("hidden"))) '
+                     'double ifn%d(ist%d *s, int x){ return s->a + x; }' % (i, i))
+        lines.append('static int isv%d = %d;' % (i, i))
+        lines.append('int ifn%dUse(int x){ ist%d s = {x, 0.0}; return ifn%d(&s, isv%d); }'
+                     % (i, i, i, i))
+    for i in range(nstructs):
+        lines.append('typedef struct { int a; double b; float c[4]; int *p; } st%d;' % i)
+        lines.append('st%d gs%d;' % (i, i))
+        lines.append('double fs%d(st%d *s){ return s->a + s->b; }' % (i, i))
+    for i in range(nglobals):
+        lines.append('int gi%d = %d;' % (i, i))
+    for i in range(nfuncs):
+        lines.append('int fn%d(int x, double y){ return x + %d; }' % (i, i))
+    return '\n'.join(lines) + '\n'
+
+
+def parseMemory(path):
+    # Peak and retained bytes of one parseDwarf, run in a fresh process the
+    # descriptor intern tables start out empty
+    gc.collect()
+    tracemalloc.start()
+    x = pyc.parseDwarf(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return peak, current
+
+
+def benchLibrary(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(genLibrary(args.funcs, args.structs, args.globals),
+                          tmpdir, 'libgen')
+        reportValue('functions', args.funcs, '')
+        reportValue('structs', args.structs, '')
+        reportValue('globals', args.globals, '')
+
+        report('parseDwarf', bestOf(lambda: pyc.parseDwarf(path), args.repeat), unit='ms')
+
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            peak, current = pool.submit(parseMemory, path).result()
+        reportValue('parseDwarf peak memory (cold)', peak // 1024, 'KiB')
+        reportValue('parseDwarf retained memory (cold)', current // 1024, 'KiB')
+        # Again here, where the timing runs already interned the descriptors
+        peak, current = parseMemory(path)
+        reportValue('parseDwarf peak memory (warm)', peak // 1024, 'KiB')
+        reportValue('parseDwarf retained memory (warm)', current // 1024, 'KiB')
+
+        cache_dir = os.path.join(tmpdir, 'cache')
+        pyc.parseDwarf(path, cache=True, cache_dir=cache_dir)
+        report('parseDwarf from cache',
+               bestOf(lambda: pyc.parseDwarf(path, cache=True, cache_dir=cache_dir),
+                      args.repeat), unit='ms')
+
+        report('cwrap()', bestOf(lambda: pyc.cwrap(path), args.repeat), unit='ms')
+        report('cwrap(lazy=True)', bestOf(lambda: pyc.cwrap(path, lazy=True),
+                                          args.repeat), unit='ms')
+
+        # First access builds the cfunc/cvar and binds the symbol
+        n = min(100, args.funcs, args.globals)
+        for lazy in [False, True]:
+            lib = pyc.cwrap(path, lazy=lazy)
+            t = time.time()
+            for i in range(n):
+                getattr(lib, 'fn%d' % i)(1, 2.0)
+            report('first call%s' % (' (lazy)' if lazy else ''), (time.time() - t) / n)
+            t = time.time()
+            for i in range(n):
+                getattr(lib, 'gi%d' % i).value
+            report('first global read%s' % (' (lazy)' if lazy else ''), (time.time() - t) / n)
+
+        # Steady state against a hand written binding
+        raw = ctypes.CDLL(path)
+        fn0 = raw.fn0
+        fn0.argtypes = [ctypes.c_int, ctypes.c_double]
+        fn0.restype = ctypes.c_int
+        f = lib.fn0
+        base = perCall(lambda: fn0(1, 2.0), args.number)
+        report('ctypes fn0(1, 2.0)', base)
+        report('cfunc fn0(1, 2.0)', perCall(lambda: f(1, 2.0), args.number), base)
+
+        c = ctypes.c_int.in_dll(raw, 'gi0')
+        v = lib.gi0
+        base = perCall(lambda: c.value, args.number)
+        report('ctypes global read', base)
+        report('cvar global read', perCall(lambda: v.value, args.number), base)
+        def set_ctypes():
+            c.value = 2
+        base = perCall(set_ctypes, args.number)
+        report('ctypes global write', base)
+        report('cvar global write', perCall(lambda: v.set(2), args.number), base)
+
+        if args.structs:
+            class st0(ctypes.Structure):
+                _fields_ = [('a', ctypes.c_int), ('b', ctypes.c_double),
+                            ('c', ctypes.c_float * 4), ('p', ctypes.POINTER(ctypes.c_int))]
+            cs = st0.in_dll(raw, 'gs0')
+            s = lib.gs0
+            base = perCall(lambda: cs.b, args.number)
+            report('ctypes struct field read', base)
+            report('cstruct field read', perCall(lambda: s['b'], args.number), base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+HOT_SOURCE = """
+#include <unistd.h>
+
+typedef struct {
+    int a;
+    double b;
+    float c;
+    int d;
+} hot_struct;
+
+hot_struct hot_s;
+
+typedef struct {
+    int n;
+    hot_struct inner;
+    double pos[3];
+} hot_outer;
+
+hot_outer hot_o;
+int hot_int = 1;
+double hot_double = 1.0;
+
+int intAdd(int x, int y){ return x + y; }
+double doubleScale(double x){ return 2.0 * x; }
+double structSum(hot_struct * s){ return s->a + s->b; }
+
+double spin(int n){
+    double x = 0.0;
+    for (int i = 0; i < n; i++) x += 1.0 / (1.0 + i);
+    return x;
+}
+
+void nap(int us){ usleep(us); }
+
+double sumStructs(const hot_struct * s, int n){
+    double res = 0.0;
+    for (int i = 0; i < n; i++) res += s[i].a + s[i].b;
+    return res;
+}
+
+double sumArr(const double * x, int n){
+    double res = 0.0;
+    for (int i = 0; i < n; i++) res += x[i];
+    return res;
+}
+"""
+
+
+class hot_struct(ctypes.Structure):
+    _fields_ = [('a', ctypes.c_int), ('b', ctypes.c_double),
+                ('c', ctypes.c_float), ('d', ctypes.c_int)]
+
+
+class hot_outer(ctypes.Structure):
+    _fields_ = [('n', ctypes.c_int), ('inner', hot_struct),
+                ('pos', ctypes.c_double * 3)]
+
+
+_results = []
+_current = None
+
+def report(name, t, base=None, unit='us'):
+    # Print a measurement and keep it for the JSON output, times are in
+    # seconds and shown in unit
+    scale = {'s': 1.0, 'ms': 1e3, 'us': 1e6}[unit]
+    if base is None:
+        print('%-36s %10.3f %s' % (name, scale * t, unit))
+    else:
+        print('%-36s %10.3f %s  (%5.2fx baseline)' % (name, scale * t, unit, t / base))
+    _results.append(OrderedDict([('benchmark', _current), ('name', name),
+                                 ('seconds', t), ('baseline_seconds', base)]))
+
+
+def reportValue(name, value, unit):
+    print('%-36s %10d %s' % (name, value, unit))
+    _results.append(OrderedDict([('benchmark', _current), ('name', name),
+                                 ('value', value), ('unit', unit)]))
+
+
+def perCall(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def benchStructField(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lib = pyc.cwrap(compileLib(HOT_SOURCE, tmpdir, 'libhot'))
+        s = lib.hot_s
+        cs = hot_struct.in_dll(lib._lib, 'hot_s')
+        n = args.number
+
+        base = perCall(lambda: cs.b, n)
+        report('ctypes field read', base)
+        report('cstruct field read', perCall(lambda: s['b'], n), base)
+
+        def set_ctypes():
+            cs.b = 2.0
+        def set_cstruct():
+            s['b'] = 2.0
+        base = perCall(set_ctypes, n)
+        report('ctypes field write', base)
+        report('cstruct field write', perCall(set_cstruct, n), base)
+
+        o = lib.hot_o
+        co = hot_outer.in_dll(lib._lib, 'hot_o')
+        base = perCall(lambda: co.inner.b, n)
+        report('ctypes nested read', base)
+        report('cstruct dotted read', perCall(lambda: o['inner.b'], n), base)
+        report('cstruct view read', perCall(lambda: o['inner']['b'], n), base)
+        base = perCall(lambda: co.pos[1], n)
+        report('ctypes array element read', base)
+        report('cstruct array element read', perCall(lambda: o['pos'][1], n), base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchStructBulk(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lib = pyc.cwrap(compileLib(HOT_SOURCE, tmpdir, 'libhot'))
+        s = lib.hot_s
+        n = args.number // 10
+
+        base = perCall(lambda: dict((k, s[k]) for k in s._ctype.keys()), n)
+        report('per field dict', base)
+        report('to_dict', perCall(s.to_dict, n), base)
+        d = s.to_dict()
+        def per_field_set():
+            for k, v in d.items():
+                s[k] = v
+        base = perCall(per_field_set, n)
+        report('per field set', base)
+        report('from_dict', perCall(lambda: s.from_dict(d), n), base)
+        one = {'b': 1.0}
+        base = perCall(lambda: s.__setitem__('b', 1.0), n)
+        report('single field set', base)
+        report('from_dict one field', perCall(lambda: s.from_dict(one), n), base)
+        snap = s.snapshot()
+        report('snapshot', perCall(s.snapshot, n))
+        report('restore', perCall(lambda: s.restore(snap), n))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchArena(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lib = pyc.cwrap(compileLib(HOT_SOURCE, tmpdir, 'libhot'))
+        proto = lib.hot_struct._ctype
+        n = 1000
+
+        def separate():
+            return [pyc.cstruct(proto._structType, proto._types) for i in range(n)]
+        base = bestOf(separate, args.repeat)
+        report('%d separate cstructs' % n, base, unit='ms')
+        report('allocate(%d)' % n, bestOf(lambda: proto.allocate(n), args.repeat),
+               base, unit='ms')
+        def cycle(arena):
+            items = [arena.new() for i in range(n)]
+            for item in items:
+                arena.free(item)
+        # The first use of a slot makes its view, later uses reuse it
+        def first():
+            t = time.time()
+            cycle(proto.allocate(n))
+            return time.time() - t
+        report('%d arena new + free, first use' % n,
+               min(first() for i in range(args.repeat)), base, unit='ms')
+        arena = proto.allocate(n)
+        cycle(arena)
+        report('%d arena new + free, recycled' % n,
+               bestOf(lambda: cycle(arena), args.repeat), base, unit='ms')
+
+        structs = separate()
+        base = bestOf(lambda: [lib.structSum(s) for s in structs], args.repeat)
+        report('%d structSum calls' % n, base, unit='ms')
+        report('sumStructs over arena', bestOf(lambda: lib.sumStructs(arena, n),
+                                               args.repeat), base, unit='ms')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _workerReady(filename):
+    # Make sure the worker has built its cwrap before the pool is timed
+    if filename is None:
+        return pyc.worker_lib().filename
+    return pyc.cwrap(filename).filename
+
+
+def benchWorkers(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(genLibrary(args.funcs, args.structs, args.globals),
+                          tmpdir, 'libgen')
+        lib = pyc.cwrap(path)
+
+        base = bestOf(lambda: pyc.cwrap(path), args.repeat)
+        report('cwrap()', base, unit='ms')
+        data = pickle.dumps(lib)
+        reportValue('pickled size', len(data) // 1024, 'KiB')
+        report('pickle.dumps', bestOf(lambda: pickle.dumps(lib), args.repeat), unit='ms')
+        report('pickle.loads', bestOf(lambda: pickle.loads(data), args.repeat),
+               base, unit='ms')
+
+        # Worker start up, spawn so the parent's memory is not inherited
+        ctx = multiprocessing.get_context('spawn')
+        nworkers = 4
+        def parseEach():
+            with ProcessPoolExecutor(nworkers, mp_context=ctx) as pool:
+                list(pool.map(_workerReady, [path] * nworkers))
+        def shipped():
+            with ProcessPoolExecutor(nworkers, mp_context=ctx, initializer=pyc.init_worker,
+                                     initargs=(lib,)) as pool:
+                list(pool.map(_workerReady, [None] * nworkers))
+        base = bestOf(parseEach, 1)
+        report('%d workers parsing' % nworkers, base, unit='s')
+        report('%d workers init_worker' % nworkers, bestOf(shipped, 1), base, unit='s')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchCallOverhead(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(HOT_SOURCE, tmpdir, 'libhot')
+        lib = pyc.cwrap(path)
+        n = args.number
+
+        # Hand written binding
+        raw = ctypes.CDLL(path)
+        intAdd = raw.intAdd
+        intAdd.argtypes = [ctypes.c_int, ctypes.c_int]
+        intAdd.restype = ctypes.c_int
+        structSum = raw.structSum
+        structSum.argtypes = [ctypes.POINTER(hot_struct)]
+        structSum.restype = ctypes.c_double
+        cs = hot_struct.in_dll(raw, 'hot_s')
+
+        f = lib.intAdd
+        base = perCall(lambda: intAdd(1, 2), n)
+        report('ctypes intAdd(1, 2)', base)
+        report('cfunc intAdd(1, 2)', perCall(lambda: f(1, 2), n), base)
+
+        f = lib.structSum
+        s = lib.hot_s
+        base = perCall(lambda: structSum(ctypes.byref(cs)), n)
+        report('ctypes structSum(&s)', base)
+        report('cfunc structSum(s)', perCall(lambda: f(s), n), base)
+
+        # NumPy array to a double *, no copy either way
+        sumArr = raw.sumArr
+        sumArr.argtypes = [ctypes.POINTER(ctypes.c_double), ctypes.c_int]
+        sumArr.restype = ctypes.c_double
+        f = lib.sumArr
+        a = np.ones(1000)
+        dp = ctypes.POINTER(ctypes.c_double)
+        base = perCall(lambda: sumArr(a.ctypes.data_as(dp), 1000), n)
+        report('ctypes sumArr(a.ctypes.data_as)', base)
+        report('cfunc sumArr(a)', perCall(lambda: f(a, 1000), n), base)
+
+        # Cost of the opt-in call instrumentation
+        lib.instrument()
+        f = lib.intAdd
+        base = perCall(lambda: intAdd(1, 2), n)
+        report('instrumented cfunc intAdd(1, 2)', perCall(lambda: f(1, 2), n), base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchVarAccess(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(HOT_SOURCE, tmpdir, 'libhot')
+        lib = pyc.cwrap(path)
+        n = args.number
+
+        c = ctypes.c_int.in_dll(ctypes.CDLL(path), 'hot_int')
+        v = lib.hot_int
+
+        base = perCall(lambda: c.value, n)
+        report('ctypes read', base)
+        report('cvar.value read', perCall(lambda: v.value, n), base)
+
+        def set_ctypes():
+            c.value = 2
+        base = perCall(set_ctypes, n)
+        report('ctypes write', base)
+        report('cvar.set write', perCall(lambda: v.set(2), n), base)
+
+        def iadd_ctypes():
+            c.value += 1
+        def iadd_cvar():
+            lib.hot_int += 1
+        base = perCall(iadd_ctypes, n)
+        report('ctypes +=', base)
+        report('cwrap attribute +=', perCall(iadd_cvar, n), base)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchFuncMap(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        lib = pyc.cwrap(compileLib(HOT_SOURCE, tmpdir, 'libhot'))
+        f = lib.doubleScale
+        x = np.random.random(args.number)
+
+        def loop():
+            return np.array([f(i) for i in x])
+
+        base = bestOf(loop, args.repeat)
+        report('python loop over __call__', base, unit='ms')
+        report('cfunc.map', bestOf(lambda: f.map(x), args.repeat), base, unit='ms')
+        report('cfunc.map chunksize=4096',
+               bestOf(lambda: f.map(x, chunksize=4096), args.repeat), base, unit='ms')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchParseScaling(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%8s %8s %10s %12s %12s' % ('chains', 'DIEs', 'decode (s)',
+                                            'resolve (s)', 'us / DIE'))
+        for n in [args.size, 2 * args.size, 4 * args.size, 8 * args.size]:
+            lib = compileLib(genTypedefChains(n, args.depth), tmpdir, 'libparse%d' % n)
+            DIEs = pyc.parsedwarf.process_file(lib)
+            t1 = bestOf(lambda: pyc.parsedwarf.process_file(lib), args.repeat)
+            t2 = bestOf(lambda: pyc.parsedwarf.parseDIE(DIEs), args.repeat)
+            print('%8d %8d %10.3f %12.3f %12.2f' % (n, len(DIEs), t1, t2,
+                                                    1e6 * t2 / len(DIEs)))
+            _results.append(OrderedDict([('benchmark', _current), ('name', 'chains=%d' % n),
+                                         ('dies', len(DIEs)), ('decode_seconds', t1),
+                                         ('resolve_seconds', t2)]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class countingFile(object):
+    # File proxy counting the calls that reach the OS file object
+    def __init__(self, f):
+        self._f = f
+        self.calls = 0
+
+    def read(self, *args):
+        self.calls += 1
+        return self._f.read(*args)
+
+    def seek(self, *args):
+        self.calls += 1
+        return self._f.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def benchElfIO(args):
+    tmpdir = tempfile.mkdtemp()
+    files = []
+    def counting_open(filename, mode='r', buffering=-1):
+        files.append(countingFile(open(filename, mode, buffering)))
+        return files[-1]
+
+    try:
+        path = compileLib(genLibrary(args.funcs, args.structs, args.globals),
+                          tmpdir, 'libgen')
+        reportValue('library size', os.path.getsize(path) // 1024, 'KiB')
+
+        process_file = pyc.parsedwarf.process_file
+        pyc.parsedwarf.open = counting_open
+        for name, use_mmap in [('file', False), ('mmap', True)]:
+            del files[:]
+            process_file(path, use_mmap=use_mmap)
+            reportValue('read/seek calls (%s)' % name, sum(f.calls for f in files), '')
+            report('process_file (%s)' % name,
+                   bestOf(lambda: process_file(path, use_mmap=use_mmap), args.repeat),
+                   unit='ms')
+    finally:
+        del pyc.parsedwarf.open
+        shutil.rmtree(tmpdir)
+
+
+def benchExported(args):
+    # Mostly internal code, only a small part of it exported
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(genLibrary(args.funcs // 10, args.structs // 10,
+                                     args.globals // 10, args.internal),
+                          tmpdir, 'libint')
+        for name, kwargs in [('all DIEs', {}), ('exported', {'exported': True})]:
+            x = pyc.parseDwarf(path, **kwargs)
+            reportValue('entries (%s)' % name, sum(len(x[k]) for k in x), '')
+            report('parseDwarf (%s)' % name,
+                   bestOf(lambda: pyc.parseDwarf(path, **kwargs), args.repeat), unit='ms')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchSelect(args):
+    # Library of several CUs of which only a few symbols are used
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ncu = 8
+        per = max(args.funcs // ncu, 1)
+        srcs = []
+        for c in range(ncu):
+            srcs.append(os.path.join(tmpdir, 'cu%d.c' % c))
+            with open(srcs[-1], 'w') as f:
+                f.write('typedef struct { int a; double b; } st%d;\n' % c)
+                f.write(''.join('int fn%d_%d(st%d * s, double y){ return s->a + %d; }\n'
+                                % (c, i, c, i) for i in range(per)))
+        path = os.path.join(tmpdir, 'libselect.so')
+        subprocess.check_output(['gcc', '-ggdb3', '-fPIC', '-shared', '-o', path] + srcs)
+
+        cases = [('everything', {}),
+                 ('include 10 functions', {'include': 'fn0_?'}),
+                 ('sources one CU', {'sources': '*cu0.c'})]
+        base = None
+        for name, kwargs in cases:
+            t = bestOf(lambda: pyc.cwrap(path, **kwargs), args.repeat)
+            report('cwrap (%s)' % name, t, base, unit='ms')
+            if base is None:
+                base = t
+            gc.collect()
+            tracemalloc.start()
+            lib = pyc.cwrap(path, **kwargs)
+            gc.collect()
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            reportValue('retained memory (%s)' % name, current // 1024, 'KiB')
+            del lib
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchReload(args):
+    # Edit-rebuild loop on a library of several CUs, one of which changes
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ncu = 8
+        per = max(args.funcs // ncu, 1)
+        srcs = []
+        for c in range(ncu):
+            srcs.append(os.path.join(tmpdir, 'cu%d.c' % c))
+            with open(srcs[-1], 'w') as f:
+                f.write(''.join('int fn%d_%d(int x, double y){ return x + %d; }\n'
+                                % (c, i, i) for i in range(per)))
+        path = os.path.join(tmpdir, 'libreload.so')
+        def build():
+            subprocess.check_output(['gcc', '-ggdb3', '-fPIC', '-shared', '-o', path] + srcs)
+        build()
+
+        lib = pyc.cwrap(path, reloadable=True)
+        for c in range(ncu):
+            getattr(lib, 'fn%d_0' % c)(1, 2.0)
+
+        base = bestOf(lambda: pyc.cwrap(path), args.repeat)
+        report('cwrap() from scratch', base, unit='ms')
+        report('reload() with no change', bestOf(lambda: lib.reload(force=True), args.repeat),
+               base, unit='ms')
+        reportValue('CUs parsed again', lib._reparsed, '')
+        for name, body in [('body change', 'x + 1000'), ('signature change', None)]:
+            with open(srcs[0], 'w') as f:
+                if body is None:
+                    f.write(''.join('int fn0_%d(int x){ return x; }\n' % i for i in range(per)))
+                else:
+                    f.write(''.join('int fn0_%d(int x, double y){ return %s; }\n' % (i, body)
+                                    for i in range(per)))
+            build()
+            t = time.time()
+            lib.reload(force=True)
+            report('reload() after %s' % name, time.time() - t, base, unit='ms')
+            reportValue('CUs parsed again', lib._reparsed, '')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchConcurrent(args):
+    # A long running C routine fanned out over threads, ctypes drops the
+    # GIL for the duration of each call
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = compileLib(HOT_SOURCE, tmpdir, 'libhot')
+        lib = pyc.cwrap(path)
+        ncalls = 8
+
+        # Blocking calls overlap on any machine, CPU bound ones need cores
+        for name, n in [('nap', 20000), ('spin', 5000000)]:
+            f = getattr(lib, name)
+            calls = [(name, (n,))] * ncalls
+
+            base = bestOf(lambda: [f(n) for i in range(ncalls)], args.repeat)
+            report('%d %s calls in a loop' % (ncalls, name), base, unit='ms')
+            report('%d %s calls run_many' % (ncalls, name),
+                   bestOf(lambda: lib.run_many(calls), args.repeat), base, unit='ms')
+
+            async def gather():
+                return await asyncio.gather(*[f.acall(n) for i in range(ncalls)])
+            report('%d %s calls gather(acall)' % (ncalls, name),
+                   bestOf(lambda: asyncio.run(gather()), args.repeat), base, unit='ms')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = OrderedDict([
+    ('library', benchLibrary),
+    ('elf_io', benchElfIO),
+    ('exported', benchExported),
+    ('select', benchSelect),
+    ('reload', benchReload),
+    ('parse_scaling', benchParseScaling),
+    ('struct_field', benchStructField),
+    ('func_map', benchFuncMap),
+    ('call_overhead', benchCallOverhead),
+    ('var_access', benchVarAccess),
+    ('struct_bulk', benchStructBulk),
+    ('arena', benchArena),
+    ('workers', benchWorkers),
+    ('concurrent', benchConcurrent),
+    ])
+
+
+def main(argv=None):
+    global _current
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--funcs', type=int, default=2000,
+                        help='Functions in the generated library')
+    parser.add_argument('--structs', type=int, default=200,
+                        help='Struct types in the generated library')
+    parser.add_argument('--globals', type=int, default=2000,
+                        help='Global variables in the generated library')
+    parser.add_argument('--internal', type=int, default=2000,
+                        help='Hidden functions in the exported benchmark library')
+    parser.add_argument('--size', type=int, default=25,
+                        help='Base problem size for parse_scaling')
+    parser.add_argument('--depth', type=int, default=20,
+                        help='Typedef nesting depth for parse_scaling')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Take the best of this many runs')
+    parser.add_argument('--number', type=int, default=100000,
+                        help='Calls per timing loop for the micro benchmarks')
+    parser.add_argument('--json', default=None,
+                        help='Write the results to this file as JSON')
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks or BENCHMARKS:
+        print('==', name)
+        _current = name
+        BENCHMARKS[name](args)
+
+    if args.json is not None:
+        meta = OrderedDict([('pyctype', pyc.__version__),
+                            ('python', platform.python_version()),
+                            ('platform', platform.platform()),
+                            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                            ('args', vars(args))])
+        with open(args.json, 'w') as f:
+            json.dump(OrderedDict([('meta', meta), ('results', _results)]), f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,20 @@ import pyctype as pyc
 import unittest
     
 import subprocess
+import ctypes
+import re
+import json
+import pickle
+import multiprocessing
+import asyncio
+import threading
+import shutil
+import tempfile
 import numpy.testing as np_test
 
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+
 from contextlib import contextmanager
 try:
     from StringIO import StringIO
@@ -42,6 +54,28 @@ def captured_output():
     finally:
         sys.stdout, sys.stderr = old_out, old_err
 
+
+@contextmanager
+def tempdir():
+    tmp = tempfile.mkdtemp()
+    try:
+        yield tmp
+    finally:
+        shutil.rmtree(tmp)
+
+
+def buildLib(tmp, name, src):
+    """
+    Compiles C source into tmp/lib<name>.so, for the few tests that need
+    a library of their own
+    """
+    fname = os.path.join(tmp, name + '.c')
+    with open(fname, 'w') as f:
+        f.write(src)
+    lib = os.path.join(tmp, 'lib%s.so' % name)
+    subprocess.check_call(['gcc', '-g', '-fPIC', '-shared', '-o', lib, fname])
+    return lib
+
 class TestStringMethods(unittest.TestCase):
     def test_mising_var(self):	
         with self.assertRaises(KeyError) as cm:
@@ -50,6 +84,14 @@ class TestStringMethods(unittest.TestCase):
     def test_global_int(self):
         self.assertEqual(x.const_int,5)
 
+    def test_global_const_array(self):
+        np_test.assert_array_equal(x.const_arr.value, [1, 2, 3])
+        with self.assertRaises(ValueError):
+            x.const_arr.value[0] = 5
+        self.assertEqual(x.const_ts_arr.value[1].a, 2)
+        with self.assertRaises(ValueError):
+            x.const_ts_arr.value[0].a = 5
+
     def test_global_const_int_set(self):
         with self.assertRaises(AttributeError) as cm:
             x.const_int = 5
@@ -61,6 +103,21 @@ class TestStringMethods(unittest.TestCase):
     def test_call_void_func(self):
         x.setpPtr()
 
+    def test_global_pointer(self):
+        x.setpPtr()
+        self.assertEqual(x.p_b_float.value, x.b_float.value)
+        self.assertEqual(x.p2_b_float.value, x.b_float.value)
+
+        x.b_float = 7.0
+        self.assertEqual(x.p2_b_float.value, 7.0)
+        x.b_float = 5.0
+
+    def test_global_int_iadd(self):
+        x.g_a_int = 1
+        x.g_a_int += 2
+        self.assertEqual(x.g_a_int, 3)
+        self.assertEqual(x.g_a_int + 1, 4)
+
     def test_call_int_func(self):
         self.assertEqual(x.intFuncNoArgs(),42)
 
@@ -83,6 +140,53 @@ class TestStringMethods(unittest.TestCase):
     def test_global_array_1d(self):
         y = x.int_arr
 
+    def test_global_array_view(self):
+        y = x.int_arr.value
+        self.assertIsInstance(y, np.ndarray)
+        self.assertEqual(y.shape, (10,))
+        self.assertEqual(y.dtype, np.int32)
+
+        y[:] = np.arange(10)
+        self.assertEqual(x.sumIntArr(), 45)
+        self.assertTrue(np.shares_memory(y, x.int_arr.value))
+
+        x.int_arr = 1
+        self.assertEqual(x.sumIntArr(), 10)
+
+    def test_global_array_2d_view(self):
+        y = x.int_arr2.value
+        self.assertEqual(y.shape, (10, 5))
+
+        y[3, 4] = 17
+        self.assertEqual(x.intArr2Elem(3, 4), 17)
+
+    def test_func_map(self):
+        a = np.arange(10, dtype=np.float32)
+        y = x.floatFunc1.map(a)
+        self.assertEqual(y.dtype, np.float32)
+        np_test.assert_array_equal(y, 2 * a)
+
+    def test_func_map_broadcast(self):
+        a = np.arange(6).reshape(2, 3)
+        y = x.intFunc2.map(a, 10)
+        self.assertEqual(y.shape, (2, 3))
+        np_test.assert_array_equal(y, a + 10)
+
+        out = np.zeros((2, 3), dtype=np.int32)
+        z = x.intFunc2.vectorize(chunksize=4)(a, np.array([1, 2, 3]), out=out)
+        self.assertIs(z, out)
+        np_test.assert_array_equal(out, a + [1, 2, 3])
+
+    def test_func_map_casting(self):
+        with self.assertRaises(TypeError):
+            x.intFunc1.map([1.7, 2.9])
+        np_test.assert_array_equal(x.intFunc1.map([True, 2]), [2, 4])
+        np_test.assert_array_equal(x.floatFunc1.map([1, 2]), [2.0, 4.0])
+
+    def test_func_map_pointer(self):
+        with self.assertRaises(TypeError) as cm:
+            x.floatptrFunc1.map(np.zeros(3))
+
     def test_setStructS1(self):
         y = x.setStructS1()
         self.assertEqual(y,1)
@@ -99,6 +203,69 @@ class TestStringMethods(unittest.TestCase):
         y = x.checkStructS1()
         self.assertEqual(y, 1)        
 
+    def test_struct_pointer_member(self):
+        z = x.ts1_1
+        self.assertEqual(z['aptr'], 0)
+
+        z['aptr'] = 1234
+        self.assertEqual(z['aptr'], 1234)
+        z['aptr'] = 0
+
+    def test_struct_to_from_dict(self):
+        z = x.ts1_1
+        z.from_dict({'a': 3, 'b': 2.5})
+        self.assertEqual(x.checkStructS1(), 1)
+
+        d = z.to_dict()
+        self.assertEqual(d['a'], 3)
+        self.assertEqual(d['b'], 2.5)
+        self.assertEqual(sorted(d), sorted(z._ctype.keys()))
+
+        z.from_dict({'a': 4})
+        self.assertEqual(z['a'], 4)
+        self.assertEqual(z['b'], 2.5)
+
+        with self.assertRaises(KeyError) as cm:
+            z.from_dict({'not_a_key': 1})
+
+    def test_struct_snapshot(self):
+        z = x.ts2_1
+        z['a2'] = 1
+        snap = z.snapshot()
+        self.assertEqual(len(snap), 40)
+
+        z['a2'] = 2
+        self.assertEqual(z.diff(snap), ['a2'])
+
+        z.restore(snap)
+        self.assertEqual(z['a2'], 1)
+        self.assertEqual(z.diff(snap), [])
+
+    def test_struct_dtype(self):
+        dt = x.test_struct.dtype
+        self.assertEqual(dt.itemsize, 32)
+        self.assertEqual(dt.fields['b'][1], 4)
+        self.assertEqual(dt.fields['aptr'][0], np.uintp)
+
+        dt = x.ts2_1.dtype
+        self.assertEqual(dt.itemsize, 40)
+        self.assertEqual(dt.fields['b1'][0], x.test_struct.dtype)
+
+    def test_struct_as_array(self):
+        z = x.ts1_1
+        y = z.as_array()
+        y.a[0] = 3
+        self.assertEqual(x.checkStructS1(), 1)
+        self.assertEqual(z['a'], 3)
+
+    def test_global_struct_array(self):
+        y = x.ts1_arr1.value
+        self.assertEqual(y.shape, (5,))
+        self.assertEqual(y.dtype.itemsize, 32)
+
+        y.b = np.arange(5)
+        self.assertEqual(x.tsArrB(3), 3.0)
+
     def test_structFunc1(self):
         y = x.test_struct
 
@@ -122,5 +289,736 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(z,y['b']+5.0)
 
 
+class TestInstrument(unittest.TestCase):
+    def test_stats(self):
+        z = pyc.cwrap('./libtester.so', instrument=True)
+        for i in range(10):
+            z.intFunc1(5)
+        y = z.test_struct
+        y['b'] = 3
+        self.assertEqual(z.structFunc2(y), 8.0)
+        s = z.stats()
+        self.assertEqual(s['intFunc1']['calls'], 10)
+        self.assertEqual(s['structFunc2']['calls'], 1)
+        self.assertTrue(s['structFunc2']['convert'] > 0.0)
+        self.assertNotIn('intFunc2', s)
+        self.assertEqual(sum(n for e, n in s['intFunc1']['histogram']), 10)
+        self.assertTrue(s['intFunc1']['p50'] <= s['intFunc1']['max'])
+        self.assertEqual(json.loads(z.dump_stats())['intFunc1']['calls'], 10)
+
+        z.reset_stats()
+        self.assertEqual(z.stats(), {})
+
+    def test_map(self):
+        z = pyc.cwrap('./libtester.so', instrument=True)
+        z.intFunc1.map(np.arange(10), chunksize=4)
+        s = z.intFunc1.stats
+        self.assertEqual(s['calls'], 10)
+        self.assertEqual(sum(n for e, n in s['histogram']), 10)
+
+    def test_toggle(self):
+        z = pyc.cwrap('./libtester.so')
+        self.assertEqual(z.intFunc1(5), 10)
+        self.assertIsNone(z.intFunc1.stats)
+        z.instrument()
+        self.assertEqual(z.intFunc1(5), 10)
+        self.assertEqual(z.intFunc1.stats['calls'], 1)
+        z.instrument(False)
+        z.intFunc1(5)
+        self.assertEqual(z.stats(), {})
+
+
+class TestConcurrent(unittest.TestCase):
+    def test_submit(self):
+        self.assertEqual(x.intFunc2.submit(5, 6).result(), 11)
+
+    def test_acall(self):
+        async def run():
+            return await asyncio.gather(x.intFunc1.acall(1), x.intFunc1.acall(2))
+        self.assertEqual(asyncio.run(run()), [2, 4])
+
+    def test_run_many(self):
+        res = x.run_many([('intFunc1', (i,)) for i in range(20)] + [(x.intFunc2, (1, 2))])
+        self.assertEqual(res, [2 * i for i in range(20)] + [3])
+
+    def test_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(2) as pool:
+            z = pyc.cwrap('./libtester.so', executor=pool)
+            self.assertEqual(z.intFunc1.submit(4).result(), 8)
+
+    def test_init_race(self):
+        z = pyc.cwrap('./libtester.so')
+        start = threading.Barrier(8)
+        res = []
+        def work():
+            start.wait()
+            res.append((z.intFunc1, z.intFunc1(3), z.const_int))
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(id(r[0]) for r in res)), 1)
+        self.assertEqual([r[1:] for r in res], [(6, 5)] * 8)
+
+    def test_init_race_lazy(self):
+        # Different entries parsed at once share one DWARF reader
+        interval = sys.getswitchinterval()
+        with tempdir() as tmp:
+            src = ''.join('typedef struct { int a%d; double b; } st%d;\n'
+                          'int fs%d(st%d * s, int k){ return k + %d; }\n'
+                          % (i, i, i, i, i) for i in range(64))
+            z = pyc.cwrap(buildLib(tmp, 'race', src), lazy=True)
+            # Switch threads often enough for the parses to interleave
+            sys.setswitchinterval(1e-6)
+            try:
+                start = threading.Barrier(16)
+                res = {}
+                def work(j):
+                    start.wait()
+                    for i in range(j, 64, 16):
+                        f = getattr(z, 'fs%d' % i)
+                        res[i] = (list(f._desc.args.keys()), f(getattr(z, 'st%d' % i), 1))
+                threads = [threading.Thread(target=work, args=(j,)) for j in range(16)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                sys.setswitchinterval(interval)
+            self.assertEqual(res, dict((i, (['s', 'k'], i + 1)) for i in range(64)))
+
+
+class TestRegistry(unittest.TestCase):
+    def test_two_libraries(self):
+        other = pyc.cwrap('./libother.so')
+        o = other.other_s
+        o['a'] = 1.5
+        o['b'] = 2
+        self.assertEqual(other.otherSum(o), 3.5)
+
+        # The first library still sees its own test_struct
+        y = x.test_struct
+        y['b'] = 3
+        self.assertEqual(x.structFunc2(y), 8.0)
+        self.assertEqual(sorted(o.to_dict().keys()), ['a', 'b'])
+        self.assertIn('bptr', y.dtype.names)
+
+    def test_interned(self):
+        with tempdir() as tmp:
+            lib = os.path.join(tmp, 'libtester.so')
+            shutil.copy('./libtester.so', lib)
+            z = pyc.cwrap(lib)
+            self.assertIs(z._types['test_struct2'], x._types['test_struct2'])
+            self.assertIsNot(z._types['test_struct2'], pyc.cwrap('./libother.so')._types['test_struct'])
+            self.assertIs(z.ts1_arr1.dtype, x.ts1_arr1.dtype)
+
+    def test_nested_layout(self):
+        # Equal outer definitions embedding different inner ones
+        with tempdir() as tmp:
+            a, b = [pyc.cwrap(buildLib(tmp, name,
+                                       'typedef struct { %s } inner;\n'
+                                       'typedef struct { int n; inner in; } outer;\n'
+                                       'outer g_o;\n'
+                                       'int getX(void){ return g_o.in.x; }\n' % inner))
+                    for name, inner in [('a', 'int x; float y;'), ('b', 'float y; int x;')]]
+            self.assertIs(a._types['outer'], b._types['outer'])
+            a.g_o['in.x'] = 11
+            b.g_o['in.x'] = 22
+            self.assertEqual(a.getX(), 11)
+            self.assertEqual(b.getX(), 22)
+            b.g_o['in']['x'] = 23
+            self.assertEqual(b.getX(), 23)
+            self.assertNotEqual(a.g_o.dtype, b.g_o.dtype)
+
+    def test_union_layout(self):
+        # Unions embedded by value are part of the layout too
+        with tempdir() as tmp:
+            a, b = [pyc.cwrap(buildLib(tmp, name,
+                                       'union U { %s };\n'
+                                       'typedef struct { int n; union U u; } outer;\n'
+                                       'outer g_o;\n' % u))
+                    for name, u in [('a', 'int x; float y;'), ('b', 'float x; int y;')]]
+            a.g_o['u.x'] = 1
+            b.g_o['u.x'] = 1.5
+            self.assertEqual(a.g_o['u.x'], 1)
+            self.assertEqual(b.g_o['u.x'], 1.5)
+            self.assertEqual(b.g_o['u']['y'], 1069547520)
+            self.assertNotEqual(a.g_o.dtype, b.g_o.dtype)
+
+
+class TestDescriptors(unittest.TestCase):
+    def test_shared(self):
+        y = pyc.parseDwarf('./libtester.so')
+        f1 = y['funcs']['intFunc1']
+        f2 = y['funcs']['intFunc2']
+        self.assertIs(f1.type, f2.type)
+        self.assertIs(f1.type, y['var']['g_a_int'].type)
+        self.assertIs(f1.args['i1'].type, f1['args']['i1']['def'])
+
+    def test_mapping(self):
+        y = pyc.parseDwarf('./libtester.so')
+        st = y['structs']['test_struct']
+        self.assertEqual(st['def']['size'], 32)
+        self.assertEqual(st['args']['bptr']['loc'], 16)
+        self.assertEqual(dict(st['def']), {'type': 'test_struct', 'ptrs': 0, 'size': 32,
+                                           'struct': True, 'array': False,
+                                           'const': False, 'union': False,
+                                           'pconst': False})
+        self.assertNotIn('def', y['funcs']['setpPtr'])
+        self.assertIsNone(y['funcs']['setpPtr'].get('def'))
+
+    def test_immutable(self):
+        y = pyc.parseDwarf('./libtester.so')
+        with self.assertRaises(AttributeError):
+            y['var']['g_a_int'].type = None
+        with self.assertRaises(TypeError):
+            y['funcs']['intFunc1']['args']['i1'] = None
+
+    def test_pickle(self):
+        import pickle
+        y = pyc.parseDwarf('./libtester.so')
+        z = pickle.loads(pickle.dumps(y))
+        self.assertEqual(z, y)
+        self.assertIs(z['structs']['test_struct'], y['structs']['test_struct'])
+
+
+class TestExported(unittest.TestCase):
+    def test_exported(self):
+        full = pyc.parseDwarf('./libtester.so')
+        y = pyc.parseDwarf('./libtester.so', exported=True)
+        self.assertIn('hiddenFunc', full['funcs'])
+        self.assertNotIn('hiddenFunc', y['funcs'])
+        self.assertNotIn('atoi', y['funcs'])
+        self.assertNotIn('static_int', y['var'])
+        self.assertNotIn('hidden_struct', y['structs'])
+        for k in ['funcs', 'var', 'structs']:
+            for name in y[k]:
+                self.assertEqual(y[k][name], full[k][name])
+        # Types reached through exported symbols are kept
+        self.assertIn('test_struct', y['structs'])
+        self.assertIn('Data', y['structs'])
+
+    def test_exported_cwrap(self):
+        z = pyc.cwrap('./libtester.so', exported=True)
+        self.assertEqual(z.callHidden(2), 5)
+        self.assertEqual(z.intFunc1(5), 10)
+        self.assertNotIn('hiddenFunc', dir(z))
+
+    def test_exported_lazy(self):
+        z = pyc.cwrap('./libtester.so', exported=True, lazy=True)
+        self.assertEqual(z.callHidden(2), 5)
+        self.assertNotIn('hiddenFunc', dir(z))
+
+
+class TestSelect(unittest.TestCase):
+    def test_include(self):
+        full = pyc.parseDwarf('./libtester.so')
+        y = pyc.parseDwarf('./libtester.so', include=['structFunc*', 'ts1_*'])
+        self.assertEqual(sorted(y['funcs']), ['structFunc1', 'structFunc2'])
+        self.assertEqual(sorted(y['var']), ['ts1_1', 'ts1_arr1'])
+        self.assertEqual(list(y['structs']), ['test_struct'])
+        self.assertEqual(y['funcs']['structFunc2'], full['funcs']['structFunc2'])
+
+    def test_regex_exclude(self):
+        y = pyc.parseDwarf('./libtester.so', include=re.compile('^cu2'),
+                           exclude='*Atoi')
+        self.assertEqual(list(y['funcs']), ['cu2StructFunc'])
+        self.assertIn('cu2_struct', y['structs'])
+        # Struct types can be asked for by name
+        y = pyc.parseDwarf('./libtester.so', include=['intFunc1', 'outer_t'])
+        self.assertEqual(list(y['funcs']), ['intFunc1'])
+        self.assertIn('outer_t', y['structs'])
+        self.assertIn('inner_t', y['structs'])
+
+    def test_sources(self):
+        y = pyc.parseDwarf('./libtester.so', sources='*testcu2.c')
+        self.assertIn('cu2StructFunc', y['funcs'])
+        self.assertNotIn('intFunc1', y['funcs'])
+        self.assertNotIn('test_struct', y['structs'])
+        z = pyc.cwrap('./libtester.so', sources='*testcu2.c', include='cu2*', lazy=True)
+        self.assertEqual(z.cu2_int, 7)
+        self.assertNotIn('intFunc1', dir(z))
+
+    def test_cache_key(self):
+        with tempdir() as cache_dir:
+            a = pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                               include='intFunc1')
+            b = pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                               include='intFunc2')
+            self.assertEqual(list(a['funcs']), ['intFunc1'])
+            self.assertEqual(list(b['funcs']), ['intFunc2'])
+            # Each filter set keeps its own entry
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            with mock.patch.object(pyc.parsedwarf, 'lazyDwarf', side_effect=AssertionError):
+                a = pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                                   include=['intFunc1'])
+                b = pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                                   include='intFunc2')
+            self.assertEqual(list(a['funcs']), ['intFunc1'])
+            self.assertEqual(list(b['funcs']), ['intFunc2'])
+            pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                           include=['a*', 'b*'])
+            pyc.parseDwarf('./libtester.so', cache=True, cache_dir=cache_dir,
+                           include=['b*', 'a*'])
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lib = os.path.join(self.tmp, 'libreload.so')
+        self.build('int alpha(int x){ return x + 1; }\nint g_alpha = 1;\n')
+        with open(os.path.join(self.tmp, 'b.c'), 'w') as f:
+            f.write('typedef struct { int a; } bst;\nbst g_b;\n'
+                    'int beta(int x){ return 2 * x; }\n')
+        self.compile()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, src):
+        with open(os.path.join(self.tmp, 'a.c'), 'w') as f:
+            f.write(src)
+
+    def compile(self):
+        subprocess.check_output(['gcc', '-ggdb3', '-fPIC', '-shared', '-o', self.lib,
+                                 os.path.join(self.tmp, 'a.c'), os.path.join(self.tmp, 'b.c')])
+
+    def test_reload(self):
+        z = pyc.cwrap(self.lib, reloadable=True)
+        self.assertFalse(z.reload())
+        self.assertEqual(z.alpha(1), 2)
+        # Unchanged CUs are not decoded
+        with mock.patch.object(pyc.parsedwarf, 'cuFingerprint', side_effect=AssertionError):
+            self.assertTrue(z.reload(force=True))
+        alpha, beta, g_b = z.alpha, z.beta, z.g_b
+
+        # New code and data, same signatures
+        self.build('int alpha(int x){ return x + 2; }\nint g_alpha = 5;\n')
+        self.compile()
+        self.assertTrue(z.reload(force=True))
+        self.assertEqual(z._reparsed, 0)
+        self.assertIs(z.alpha, alpha)
+        self.assertIs(z.beta, beta)
+        self.assertIs(z.g_b, g_b)
+        self.assertEqual(z.alpha(1), 3)
+        self.assertEqual(z.g_alpha, 5)
+        self.assertEqual(z.beta(2), 4)
+
+        # Changed signature, only a.c's CU is parsed
+        self.build('int alpha(int x, int y){ return x + y; }\n')
+        self.compile()
+        self.assertTrue(z.reload(force=True))
+        self.assertEqual(z._reparsed, 1)
+        self.assertIsNot(z.alpha, alpha)
+        self.assertIs(z.beta, beta)
+        self.assertEqual(z.alpha(1, 5), 6)
+        self.assertNotIn('g_alpha', dir(z))
+
+    def test_reload_lazy(self):
+        copies = os.path.join(self.tmp, 'copies')
+        os.mkdir(copies)
+        z = pyc.cwrap(self.lib, lazy=True, copy_dir=copies)
+        self.assertEqual(z.alpha(1), 2)
+        old = z._funcs
+        with mock.patch.object(pyc.pyctype.tempfile, 'mkstemp',
+                               wraps=tempfile.mkstemp) as mkstemp:
+            self.assertTrue(z.reload(force=True))
+        self.assertEqual(mkstemp.call_args[1]['dir'], copies)
+        # Only the entry in use was parsed again, the old file is closed
+        self.assertEqual(list(z._funcs._data), ['alpha'])
+        self.assertEqual(z.alpha(1), 2)
+        self.assertTrue(old._resolve.__self__._file._file.closed)
+
+    def test_watch_error(self):
+        z = pyc.cwrap(self.lib)
+        errors = []
+        done = threading.Event()
+        def onerror(lib, e):
+            errors.append(e)
+            done.set()
+        z.watch(0.05, onerror=onerror)
+        try:
+            # Replaced, not truncated, the loaded mapping stays valid
+            bad = os.path.join(self.tmp, 'bad.so')
+            with open(bad, 'wb') as f:
+                f.write(b'not a library')
+            os.replace(bad, self.lib)
+            self.assertTrue(done.wait(10))
+        finally:
+            z.unwatch()
+        self.assertIsInstance(errors[0], OSError)
+        self.assertEqual(z.alpha(1), 2)
+
+    def test_watch(self):
+        z = pyc.cwrap(self.lib)
+        self.assertEqual(z.alpha(1), 2)
+        done = threading.Event()
+        z.watch(0.05, callback=lambda lib: done.set())
+        try:
+            self.build('int alpha(int x){ return x + 3; }\n')
+            self.compile()
+            # Make sure the stamp changes on filesystems with coarse mtimes
+            st = os.stat(self.lib)
+            os.utime(self.lib, (st.st_atime, st.st_mtime + 1))
+            self.assertTrue(done.wait(10))
+        finally:
+            z.unwatch()
+        self.assertEqual(z.alpha(1), 4)
+
+
+class TestBufferArgs(unittest.TestCase):
+    def test_numpy(self):
+        a = np.arange(5, dtype=np.float64)
+        self.assertEqual(x.sumDoubles(a, 5), 10.0)
+        # Read only data is fine for a const pointer
+        a.flags.writeable = False
+        self.assertEqual(x.sumDoubles(a, 5), 10.0)
+
+    def test_inplace(self):
+        a = np.arange(4, dtype=np.int32)
+        x.scaleInts(a, 4, 3)
+        np_test.assert_array_equal(a, [0, 3, 6, 9])
+
+        import array
+        b = array.array('i', [1, 2])
+        x.scaleInts(b, 2, 2)
+        self.assertEqual(list(b), [2, 4])
+        x.scaleInts(memoryview(b), 2, 2)
+        self.assertEqual(list(b), [4, 8])
+
+    def test_checks(self):
+        with self.assertRaises(TypeError):
+            x.scaleInts(np.zeros(4), 4, 2)
+        with self.assertRaises(ValueError):
+            x.scaleInts(np.zeros((4, 4), dtype=np.int32)[:, 0], 4, 2)
+        a = np.zeros(4, dtype=np.int32)
+        a.flags.writeable = False
+        with self.assertRaises(ValueError):
+            x.scaleInts(a, 4, 2)
+        # A const pointer can still write the data
+        b = np.zeros(3)
+        b.flags.writeable = False
+        with self.assertRaises(ValueError):
+            x.fillOnes(b, 3)
+        np_test.assert_array_equal(b, [0.0, 0.0, 0.0])
+        self.assertFalse(x.fillOnes._desc.args['x'].type.pconst)
+        self.assertTrue(x.sumDoubles._desc.args['x'].type.pconst)
+
+    def test_scalar(self):
+        self.assertEqual(x.floatptrFunc1(2.0), 2.0)
+        c = ctypes.c_int(5)
+        x.scaleInts(c, 1, 2)
+        self.assertEqual(c.value, 10)
+
+    def test_rows(self):
+        a = np.arange(12, dtype=np.float64).reshape(3, 4)
+        self.assertEqual(x.sumRows(a, 3, 4), a.sum())
+        self.assertEqual(x.sumRows(a[::2], 2, 4), a[::2].sum())
+        rows = [np.ones(2), np.full(2, 2.0)]
+        self.assertEqual(x.sumRows(rows, 2, 2), 6.0)
+
+    def test_void(self):
+        self.assertEqual(x.countBytes(bytearray(b'\x01\x02\x03'), 3), 6)
+        with self.assertRaises(ValueError):
+            x.countBytes(b'\x01', 1)
+        self.assertEqual(x.countBytes(np.ones(2, dtype=np.int16), 4), 2)
+
+    def test_pointer_values(self):
+        h = x.getHandle()
+        self.assertIsInstance(h, int)
+        self.assertEqual(x.useHandle(h), 42)
+        self.assertEqual(x.useHandle(ctypes.c_void_p(h)), 42)
+        self.assertEqual(x.strToInt(ctypes.c_char_p(b'12')), 12)
+
+
+class TestNested(unittest.TestCase):
+    def test_nested_struct(self):
+        y = x.outer_s
+        inner = y['inner']
+        inner['pos'][:] = [1.0, 2.0, 3.0]
+        self.assertEqual(x.outerPos(1), 2.0)
+        y['inner.pos'][2] = 7.0
+        self.assertEqual(x.outerPos(2), 7.0)
+        np_test.assert_array_equal(y['inner.pos'], [1.0, 2.0, 7.0])
+
+    def test_array_members(self):
+        y = x.outer_s
+        ids = y['many'][1]['ids']
+        self.assertEqual(ids.shape, (2, 2))
+        ids[1, 0] = 12
+        self.assertEqual(x.outerId(1, 0), 12)
+        self.assertEqual(y['many'].shape, (2,))
+
+    def test_union(self):
+        y = x.outer_s
+        y['u.a'] = 1
+        self.assertEqual(y['u']['a'], 1)
+        y['u.b'] = 1.0
+        self.assertEqual(y['u.a'], 1065353216)
+
+    def test_set_aggregate(self):
+        y = x.outer_s
+        y['inner.pos'] = [4.0, 5.0, 6.0]
+        self.assertEqual(x.outerPos(0), 4.0)
+        y['inner'] = {'pos': [1.0, 1.0, 1.0], 'ids': [[1, 2], [3, 4]]}
+        self.assertEqual(x.outerPos(2), 1.0)
+        self.assertEqual(y['inner.ids'][1, 0], 3)
+        y['n'] = 3
+        self.assertEqual(y['n'], 3)
+
+    def test_dtype(self):
+        y = x.outer_s
+        self.assertEqual(y.dtype.itemsize, 136)
+        self.assertEqual(y.dtype.fields['u'][1], 48)
+        u = pyc.structDtype(x._types['Data'], x._types)
+        self.assertEqual([u.fields[k][1] for k in u.names], [0, 0])
+        arr = x.outer_t.allocate(2).as_array()
+        self.assertEqual(arr.shape, (2,))
+
+    def test_bitfield(self):
+        y = x.bf_s
+        y['c'] = 4
+        self.assertEqual(y['c'], 4)
+        with self.assertRaises(TypeError):
+            y['f1']
+        with self.assertRaises(TypeError):
+            y['f2'] = 3
+        self.assertEqual(y.to_dict(), {'c': 4})
+        self.assertEqual(y.dtype.names, ('c',))
+
+    def test_bad_path(self):
+        with self.assertRaises(KeyError):
+            x.outer_s['inner.nope']
+        with self.assertRaises(KeyError):
+            x.outer_s['n.a']
+
+
+class TestArena(unittest.TestCase):
+    def test_allocate(self):
+        arena = x.test_struct.allocate(4)
+        self.assertEqual(len(arena), 4)
+        self.assertEqual(ctypes.addressof(arena._data) % 16, 0)
+        for i, s in enumerate(arena):
+            s['a'] = i
+            s['b'] = 0.5
+        self.assertEqual(x.sumStructs(arena, 4), 8.0)
+        self.assertEqual(x.structFunc2(arena[2]), 5.5)
+        np_test.assert_array_equal(arena.as_array().a, [0, 1, 2, 3])
+        self.assertEqual(arena[-1]['a'], 3)
+        with self.assertRaises(IndexError):
+            arena[4]
+
+    def test_recycle(self):
+        arena = x.test_struct.allocate(2)
+        a = arena.new()
+        b = arena.new()
+        self.assertEqual(arena.available, 0)
+        with self.assertRaises(MemoryError):
+            arena.new()
+        a['a'] = 5
+        arena.free(a)
+        with self.assertRaises(ValueError):
+            arena.free(a)
+        c = arena.new()
+        self.assertEqual(c['a'], 0)
+        self.assertEqual(ctypes.addressof(c._buffer), ctypes.addressof(arena[0]._buffer))
+        with self.assertRaises(ValueError):
+            arena.free(x.ts1_1._ctype)
+
+    def test_new_zeroed(self):
+        # Writes that never went through new still get cleared
+        arena = x.test_struct.allocate(2)
+        arena[0]['a'] = 5
+        arena.as_array().b[1] = 2.5
+        for s in [arena.new(), arena.new()]:
+            self.assertEqual(s['a'], 0)
+            self.assertEqual(s['b'], 0.0)
+
+
+class TestPickle(unittest.TestCase):
+    def test_roundtrip(self):
+        y = pyc.cwrap('./libtester.so', instrument=True)
+        y.const_int
+        y.structFunc2
+        y.test_struct
+        data = pickle.dumps(y)
+        with mock.patch.object(pyc.pyctype, 'parseDwarf', side_effect=AssertionError):
+            z = pickle.loads(data)
+        self.assertEqual(z.const_int, 5)
+        self.assertEqual(set(dir(z)), set(dir(x)))
+        s = z.test_struct.allocate(1)[0]
+        s['b'] = 1.0
+        self.assertEqual(z.structFunc2(s), 6.0)
+        self.assertNotEqual(z.stats(), {})
+
+    def test_lazy(self):
+        y = pyc.cwrap('./libtester.so', lazy=True)
+        z = pickle.loads(pickle.dumps(y))
+        self.assertEqual(z.const_int, 5)
+        self.assertEqual(z._funcs['structFunc2'], x._funcs['structFunc2']._desc)
+
+    def test_pool(self):
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, mp_context=ctx, initializer=pyc.init_worker,
+                                 initargs=(x,)) as pool:
+            z = pool.submit(pyc.worker_lib).result()
+        self.assertEqual(z.filename, x.filename)
+        self.assertEqual(z.const_int, 5)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lib = os.path.join(self.tmp, 'libtester.so')
+        shutil.copy('./libtester.so', self.lib)
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cache_roundtrip(self):
+        from pyctype.dwarfcache import loadCache, cacheFile
+        self.assertIsNone(loadCache(self.lib, self.cache_dir))
+
+        y = pyc.parseDwarf(self.lib, cache=True, cache_dir=self.cache_dir)
+        self.assertTrue(os.path.exists(cacheFile(self.lib, self.cache_dir)))
+        self.assertEqual(loadCache(self.lib, self.cache_dir), y)
+        self.assertEqual(pyc.parseDwarf(self.lib, cache=True,
+                                        cache_dir=self.cache_dir), y)
+
+    def test_cache_invalidate(self):
+        from pyctype.dwarfcache import loadCache
+        pyc.parseDwarf(self.lib, cache=True, cache_dir=self.cache_dir)
+
+        st = os.stat(self.lib)
+        os.utime(self.lib, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNone(loadCache(self.lib, self.cache_dir))
+
+    def test_cache_options(self):
+        # Parses with other options keep their own entries
+        from pyctype.dwarfcache import loadCache
+        full = pyc.parseDwarf(self.lib, cache=True, cache_dir=self.cache_dir)
+        exported = pyc.parseDwarf(self.lib, cache=True, cache_dir=self.cache_dir,
+                                  exported=True)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(loadCache(self.lib, self.cache_dir), full)
+        self.assertEqual(loadCache(self.lib, self.cache_dir, (('exported', True),)),
+                         exported)
+
+    def test_cache_cwrap(self):
+        z = pyc.cwrap(self.lib, cache=True, cache_dir=self.cache_dir)
+        z = pyc.cwrap(self.lib, cache=True, cache_dir=self.cache_dir)
+        self.assertEqual(z.intFunc1(5), 10)
+
+    def test_cache_lazy(self):
+        # The name index is cached, entries are parsed on access
+        z = pyc.cwrap(self.lib, cache=True, cache_dir=self.cache_dir, lazy=True)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        with mock.patch.object(pyc.parsedwarf.lazyDwarf, '_buildIndex',
+                               side_effect=AssertionError):
+            z = pyc.cwrap(self.lib, cache=True, cache_dir=self.cache_dir, lazy=True)
+        self.assertEqual(z.intFunc2(5, 6), 11)
+        self.assertEqual(sorted(dir(z)), sorted(dir(pyc.cwrap(self.lib, lazy=True))))
+
+    def test_cache_unwritable(self):
+        # A cache directory that can not be made only skips caching
+        cache_dir = os.path.join(self.lib, 'cache')
+        z = pyc.cwrap(self.lib, cache=True, cache_dir=cache_dir)
+        self.assertEqual(z.intFunc1(5), 10)
+        self.assertEqual(os.listdir(self.tmp), ['libtester.so'])
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy_matches_eager(self):
+        eager = pyc.parseDwarf('./libtester.so')
+        lazy = pyc.parseDwarf('./libtester.so', lazy=True)
+        for k in ['funcs', 'var', 'structs']:
+            self.assertEqual(sorted(lazy[k].keys()), sorted(eager[k].keys()))
+            for name in eager[k].keys():
+                if k == 'funcs':
+                    # Unnamed arguments are numbered in the order they are looked up
+                    self.assertEqual(list(lazy[k][name]['args'].values()),
+                                     list(eager[k][name]['args'].values()))
+                    self.assertEqual(lazy[k][name].get('def'), eager[k][name].get('def'))
+                else:
+                    self.assertEqual(lazy[k][name], eager[k][name])
+
+    def test_lazy_cwrap(self):
+        z = pyc.cwrap('./libtester.so', lazy=True)
+        self.assertEqual(z.intFunc2(5, 6), 11)
+        self.assertEqual(z.const_int, 5)
+        self.assertTrue('intFunc1' in dir(z))
+
+        y = z.test_struct
+        y['a'] = 1
+        y['b'] = 3
+        self.assertEqual(z.structFunc2(y), y['b'] + 5.0)
+
+
+class TestParallel(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        self.assertTrue(len(pyc.parsedwarf.cuChunks('./libtester.so', 4)) > 1)
+        serial = pyc.parseDwarf('./libtester.so')
+        parallel = pyc.parseDwarf('./libtester.so', workers=2)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(list(parallel['funcs']), list(serial['funcs']))
+        self.assertEqual(list(parallel['funcs']['atoi']['args']), ['NONAME0002'])
+
+    def test_parallel_cwrap(self):
+        z = pyc.cwrap('./libtester.so', workers=2)
+        self.assertEqual(z.cu2_int, 7)
+        self.assertEqual(z.intFunc1(5), 10)
+
+
+class TestGenerate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_generate(self):
+        import importlib.util
+        from pyctype.runner import main
+
+        out = os.path.join(self.tmp, 'bindings.py')
+        self.assertEqual(main(['generate', './libtester.so', '-o', out]), 0)
+
+        spec = importlib.util.spec_from_file_location('bindings', out)
+        b = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(b)
+
+        self.assertEqual(b.intFunc2(5, 6), 11)
+        self.assertEqual(b.floatFunc1(20.0), 40.0)
+        self.assertEqual(b.const_int, 5)
+
+        lib = b.load()
+        lib.g_a_int = 12
+        self.assertEqual(lib.g_a_int, 12)
+        with self.assertRaises(AttributeError) as cm:
+            lib.const_int = 1
+
+        self.assertEqual(ctypes.sizeof(b.test_struct), 32)
+        self.assertEqual(ctypes.sizeof(b.test_struct2), 40)
+        self.assertEqual(b.test_struct.b.offset, 4)
+
+        s = b.test_struct(a=1, b=3.0)
+        self.assertEqual(b.structFunc2(ctypes.byref(s)), 8.0)
+
+        self.assertIs(dict(b.outer_t._fields_)['u'], b.Data)
+        lib.test_union = b.Data(b=1.0)
+        self.assertEqual(lib.test_union.a, 1065353216)
+        o = b.outer_t()
+        o.u.a = 7
+        self.assertEqual(o.u.a, 7)
+
+        self.assertEqual(ctypes.sizeof(b.bf_t), 8)
+        lib.bf_s = b.bf_t(f1=3, f2=9, c=100)
+        self.assertEqual(lib.bfSum(), 112)
+
+
 if __name__ == '__main__':
 	unittest.main() 
\ No newline at end of file
@@ -47,6 +47,8 @@ test_struct ts1_1;
 
 const int const_int=5;
 const float pi=3.14;
+const int const_arr[3] = {1, 2, 3};
+const test_struct const_ts_arr[2] = {{1, 1.0}, {2, 2.0}};
 
 #define MYDEF 1;
 
@@ -98,8 +100,128 @@ int setStructS1(){
     return ts1_1.a;
 }
 
+int sumIntArr(){
+    int i, res = 0;
+    for(i=0;i<10;i++) res += int_arr[i];
+    return res;
+}
+
+int intArr2Elem(int i, int j){
+    return int_arr2[i][j];
+}
+
+float tsArrB(int i){
+    return ts1_arr1[i].b;
+}
+
+int strToInt(const char * s){
+    return atoi(s);
+}
+
 int checkStructS1(){
     if (ts1_1.a == 3) return 1;
     else return 0;
 }
 
+
+// Internal helpers, in the DWARF but not in .dynsym
+static int static_int = 3;
+
+typedef struct{
+    int h;
+} hidden_struct;
+
+__attribute__((visibility("hidden"))) int hiddenFunc(hidden_struct * s){
+    return s->h + static_int;
+}
+
+int callHidden(int i){
+    hidden_struct s = {i};
+    return hiddenFunc(&s);
+}
+
+// Pointer arguments for buffer passing
+double sumDoubles(const double * x, int n){
+    double res = 0.0;
+    int i;
+    for(i=0;i<n;i++) res += x[i];
+    return res;
+}
+
+void scaleInts(int * x, int n, int factor){
+    int i;
+    for(i=0;i<n;i++) x[i] *= factor;
+}
+
+double sumRows(double ** x, int nrows, int ncols){
+    double res = 0.0;
+    int i, j;
+    for(i=0;i<nrows;i++)
+        for(j=0;j<ncols;j++) res += x[i][j];
+    return res;
+}
+
+int countBytes(void * data, int n){
+    int i, res = 0;
+    for(i=0;i<n;i++) res += ((unsigned char *) data)[i];
+    return res;
+}
+
+// Nested aggregates
+typedef struct{
+    double pos[3];
+    int ids[2][2];
+} inner_t;
+
+typedef struct{
+    int n;
+    inner_t inner;
+    union Data u;
+    inner_t many[2];
+} outer_t;
+
+outer_t outer_s;
+
+double outerPos(int i){
+    return outer_s.inner.pos[i];
+}
+
+int outerId(int i, int j){
+    return outer_s.many[1].ids[i][j];
+}
+
+// Arrays of structs
+float sumStructs(test_struct * s, int n){
+    float res = 0.0;
+    for (int i = 0; i < n; i++) res += s[i].a + s[i].b;
+    return res;
+}
+
+// Opaque handles
+static int handle_data = 42;
+
+void * getHandle(){
+    return &handle_data;
+}
+
+int useHandle(void * h){
+    return *(int *)h;
+}
+
+// Bitfields
+typedef struct{
+    unsigned f1:3;
+    unsigned f2:5;
+    int c;
+} bf_t;
+
+bf_t bf_s;
+
+int bfSum(){
+    return bf_s.f1 + bf_s.f2 + bf_s.c;
+}
+
+// Const pointer to writable data
+void fillOnes(double * const x, int n){
+    for (int i = 0; i < n; i++) x[i] = 1.0;
+}
@@ -0,0 +1,18 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+typedef struct{
+    int x;
+    double y;
+} cu2_struct;
+
+cu2_struct cu2_s;
+int cu2_int = 7;
+
+int cu2Atoi(const char * s){
+    return atoi(s);
+}
+
+double cu2StructFunc(cu2_struct * s){
+    return s->x + s->y;
+}
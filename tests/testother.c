@@ -0,0 +1,12 @@
+// A second library reusing struct names from test.c with other layouts
+
+typedef struct{
+    double a;
+    int b;
+} test_struct;
+
+test_struct other_s;
+
+double otherSum(test_struct * s){
+    return s->a + s->b;
+}